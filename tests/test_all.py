@@ -17,15 +17,18 @@
 """Unit tests for the zhmc_prometheus_exporter"""
 
 import re
-import time
+import contextlib
 import datetime
-import hashlib
+import io
 import os
-import sys
+import tempfile
+import threading
+import uuid
 import unittest
-import stat  # pylint: disable=wrong-import-order  # reported on Windows
+from unittest import mock
 
 import pytest
+import yaml
 import zhmcclient
 import zhmcclient_mock
 
@@ -33,15 +36,91 @@ from zhmc_prometheus_exporter.vendor import prometheus_client
 from zhmc_prometheus_exporter import zhmc_prometheus_exporter
 
 
+# Test data that is shared by multiple tests. The tests must not modify it.
+
+# HMC and SE versions and features used by the tests
+TEST_HMC_VERSION = '2.15.0'
+TEST_HMC_API_VERSION = (3, 13)
+TEST_HMC_FEATURES = []
+TEST_SE_VERSIONS_BY_CPC = {'cpc_1': '2.15.0'}
+TEST_SE_FEATURES_BY_CPC = {'cpc_1': []}
+
+# Fixed timestamp of the faked metric values. The exporter does not use the
+# timestamp, so a constant keeps the tests deterministic
+TEST_METRICS_TIMESTAMP = datetime.datetime(2020, 1, 1, 0, 0, 0)
+
+# Metric values of the dpm-system-usage-overview metric group for cpc_1 in
+# the faked HMC of setup_faked_session(), as tuple(metric_name, value)
+TEST_DPM_METRIC_VALUES = (
+    ("processor-usage", 1),
+    ("network-usage", 2),
+    ("storage-usage", 3),
+    ("accelerator-usage", 4),
+    ("crypto-usage", 5),
+    ("power-consumption-watts", 100),
+    ("temperature-celsius", 10),
+    ("cp-shared-processor-usage", 1),
+    ("cp-dedicated-processor-usage", 2),
+    ("ifl-shared-processor-usage", 3),
+    ("ifl-dedicated-processor-usage", 4),
+)
+
+# Exporter config dict that exports the dpm-system-usage-overview metric group
+TEST_CONFIG_DICT = {
+    "hmcs": [
+        {"host": "192.168.0.0", "userid": "user", "password": "pwd"}
+    ],
+    "metric_groups": {
+        "dpm-system-usage-overview": {"export": True},
+    }
+}
+
+# Metric definition file items for the dpm-system-usage-overview metric group
+TEST_YAML_METRIC_GROUPS = {
+    "dpm-system-usage-overview": {"prefix": "pre"},
+}
+TEST_YAML_METRICS = {
+    "dpm-system-usage-overview": {
+        "processor-usage": {
+            "percent": True,
+            "exporter_name": "processor_usage",
+            "exporter_desc": "processor_usage description"
+        }
+    }
+}
+TEST_YAML_FETCH_PROPERTIES = {
+    "cpc": [
+        {"property_name": "processor-count-spare"},
+    ],
+}
+
+
 class TestParseArgs(unittest.TestCase):
     """Tests parse_args."""
 
     def test_args_store(self):
         """Tests generic input."""
-        args = (zhmc_prometheus_exporter.
-                parse_args(["-p", "1", "-c", "2"]))
-        self.assertEqual(args.p, "1")
+        args = zhmc_prometheus_exporter.parse_args(["-p", "1", "-c", "2"])
+        self.assertEqual(args.p, 1)
+        self.assertEqual(args.c, "2")
+
+    def test_args_from_file(self):
+        """Tests arguments read from a file specified as @FILE."""
+        fd, filename = tempfile.mkstemp(suffix='.args')
+        with os.fdopen(fd, "w", encoding='utf-8') as argsfile:
+            argsfile.write("-p\n1\n--log-comp\nhmc=debug\n")
+        self.addCleanup(os.remove, filename)
+        args = zhmc_prometheus_exporter.parse_args(
+            [f"@{filename}", "-c", "2"])
+        self.assertEqual(args.p, 1)
         self.assertEqual(args.c, "2")
+        self.assertEqual(args.log_complevels, ["hmc=debug"])
+
+    def test_invalid_port(self):
+        """Tests that a non-integer port is rejected by the parser."""
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                zhmc_prometheus_exporter.parse_args(["-p", "abc"])
 
     def test_default_args(self):
         """Tests for all defaults."""
@@ -53,61 +132,157 @@ class TestParseArgs(unittest.TestCase):
 class TestParseYaml(unittest.TestCase):
     """Tests parse_yaml_file."""
 
+    def make_temp_file(self, content=""):
+        """
+        Create a temporary file with the specified content and return its
+        file name. The file is removed when the test ends.
+        """
+        fd, filename = tempfile.mkstemp(suffix='.yaml')
+        with os.fdopen(fd, "w", encoding='utf-8') as testfile:
+            testfile.write(content)
+        self.addCleanup(os.remove, filename)
+        return filename
+
     def test_normal_input(self):
-        """Tests if some generic file is correctly parsed."""
-        # Get a SHA256 of Unixtime to create a filename that does not exist
-        filename = str(hashlib.sha256(str(time.time()).encode("utf-8")).
-                       hexdigest())
-        with open(filename, "w+", encoding='utf-8') as testfile:
-            testfile.write("""metrics:
+        """Tests if some generic YAML content is correctly parsed."""
+        expected_dict = {"metrics": {"hmc": "127.0.0.1",
+                                     "userid": "user",
+                                     "password": "pwd"}}
+        for round_trip in (True, False):
+            with self.subTest(round_trip=round_trip):
+                stream = io.StringIO("""metrics:
   hmc: 127.0.0.1
   userid: user
   password: pwd
 """)
-        expected_dict = {"metrics": {"hmc": "127.0.0.1",
-                                     "userid": "user",
-                                     "password": "pwd"}}
+                result = zhmc_prometheus_exporter.parse_yaml_stream(
+                    stream, 'test file', round_trip=round_trip)
+                self.assertEqual(result, expected_dict)
+                if not round_trip:
+                    self.assertIs(type(result), dict)
+
+    def test_yaml_error(self):
+        """Tests if invalid YAML content is correctly handled."""
+        for round_trip in (True, False):
+            with self.subTest(round_trip=round_trip):
+                stream = io.StringIO("metrics: [\n")
+                with self.assertRaises(zhmc_prometheus_exporter.ImproperExit):
+                    zhmc_prometheus_exporter.parse_yaml_stream(
+                        stream, 'test file', round_trip=round_trip)
+
+    def test_schema_validation_error(self):
+        """Tests if content that violates the schema is correctly handled."""
+        stream = io.StringIO("hmcs: 42\n")
+        with self.assertRaises(zhmc_prometheus_exporter.ImproperExit) as cm:
+            zhmc_prometheus_exporter.parse_yaml_stream(
+                stream, 'test file', 'config_schema.yaml')
+        self.assertIn("failed on element 'hmcs'", str(cm.exception))
+
+    def test_schema_loader(self):
+        """Tests that schema files use the C loader of PyYAML if available."""
+        if yaml.__with_libyaml__:
+            exp_loader = yaml.CSafeLoader
+        else:
+            exp_loader = yaml.SafeLoader
+        self.assertIs(zhmc_prometheus_exporter.PyYAMLSafeLoader, exp_loader)
+
+    def test_schema_validator_cached(self):
+        """Tests that the validator for a schema file is created only once."""
+        validator1 = zhmc_prometheus_exporter.schema_validator(
+            'config_schema.yaml')
+        validator2 = zhmc_prometheus_exporter.schema_validator(
+            'config_schema.yaml')
+        self.assertIs(validator2, validator1)
+
+    def test_normal_file(self):
+        """Tests if some generic file is correctly parsed."""
+        filename = self.make_temp_file("metrics:\n  hmc: 127.0.0.1\n")
         self.assertEqual(
             zhmc_prometheus_exporter.parse_yaml_file(filename, 'test file'),
-            expected_dict)
-        os.remove(filename)
+            {"metrics": {"hmc": "127.0.0.1"}})
 
     def test_permission_error(self):
         """Tests if permission denied is correctly handled."""
-
-        if sys.platform == 'win32':
-            pytest.skip("Test not supported on Windows")
-
-        filename = str(hashlib.sha256(str(time.time()).encode("utf-8")).
-                       hexdigest())
-        with open(filename, "w+", encoding='utf-8'):
-            pass
-        # Make it unreadable (mode 000)
-        os.chmod(filename, not stat.S_IRWXU)
-        with self.assertRaises(zhmc_prometheus_exporter.ImproperExit):
-            zhmc_prometheus_exporter.parse_yaml_file(
-                filename, 'test file')
-        os.remove(filename)
+        filename = self.make_temp_file()
+        # Simulate an unreadable file. Making it unreadable with chmod does
+        # not work when running as root or on Windows.
+        with mock.patch('builtins.open', side_effect=PermissionError):
+            with self.assertRaises(zhmc_prometheus_exporter.ImproperExit):
+                zhmc_prometheus_exporter.parse_yaml_file(
+                    filename, 'test file')
 
     def test_not_found_error(self):
         """Tests if file not found is correctly handled."""
-        filename = str(hashlib.sha256(str(time.time()).encode("utf-8")).
-                       hexdigest())
+        filename = os.path.join(
+            tempfile.gettempdir(), f"nonexistent_{uuid.uuid4()}.yaml")
         with self.assertRaises(zhmc_prometheus_exporter.ImproperExit):
             zhmc_prometheus_exporter.parse_yaml_file(filename, 'test file')
 
+    def test_cached(self):
+        """Tests that an unchanged file is returned from the cache."""
+        filename = self.make_temp_file("metrics:\n  hmc: 127.0.0.1\n")
+
+        result1 = zhmc_prometheus_exporter.parse_yaml_file(
+            filename, 'test file')
+        key = zhmc_prometheus_exporter.yaml_cache_key(filename, None)
+        self.assertIn(key, zhmc_prometheus_exporter.YAML_CACHE)
+
+        # Modifying the result must not affect the cached object
+        result1["metrics"]["hmc"] = "modified"
+        result2 = zhmc_prometheus_exporter.parse_yaml_file(
+            filename, 'test file')
+        self.assertEqual(result2, {"metrics": {"hmc": "127.0.0.1"}})
+
+        # A changed file must be parsed again
+        with open(filename, "w", encoding='utf-8') as testfile:
+            testfile.write("metrics:\n  hmc: 10.11.12.13\n")
+        result3 = zhmc_prometheus_exporter.parse_yaml_file(
+            filename, 'test file')
+        self.assertEqual(result3, {"metrics": {"hmc": "10.11.12.13"}})
+
+
+@pytest.fixture(scope='module')
+def faked_client():
+    """
+    Client for a faked session with setup_faked_session(), shared by the
+    tests that only read from the faked HMC.
+    """
+    return zhmcclient.Client(setup_faked_session())
+
+
+TESTCASES_JSON_PATH_STR = [
+    # (path_list, exp_result)
+    ([], "root elements"),
+    (['hmcs'], "element 'hmcs'"),
+    (['hmcs', 0, 'host'], "element 'hmcs[0].host'"),
+    ([0, 'a'], "element '[0].a'"),
+]
+
+
+@pytest.mark.parametrize(
+    "path_list, exp_result", TESTCASES_JSON_PATH_STR
+)
+def test_json_path_str(path_list, exp_result):
+    """
+    Tests json_path_str().
+    """
+    result = zhmc_prometheus_exporter.json_path_str(path_list)
+    assert result == exp_result
+
 
 TESTCASES_SPLIT_VERSION = [
     # (version_str, pad_to, exp_result)
     ('', 0, (0,)),
     ('', 1, (0,)),
     ('', 2, (0, 0)),
+    ('', 3, (0, 0, 0)),
     ('.', 0, (0, 0)),
     ('.', 2, (0, 0)),
     ('.', 3, (0, 0, 0)),
     ('1', 0, (1,)),
     ('1', 1, (1,)),
     ('1', 2, (1, 0)),
+    ('1', 3, (1, 0, 0)),
     ('1.', 0, (1, 0)),
     ('1.', 2, (1, 0)),
     ('1.', 3, (1, 0, 0)),
@@ -167,6 +342,8 @@ TESTCASES_EVAL_CONDITION = [
     ("se_version <= '2.13.1'", '2.14', '2.13', True),
     ("se_version >= '2.13' and se_version <= '2.14'", '2.14', '2.13', True),
     ("se_version >= '2.13' and se_version <= '2.14'", '2.14', '2.15', False),
+    ('hmc_version >= "2.14" and se_version <= \'2.14\'', '2.14', '2.13',
+     True),
 ]
 
 
@@ -175,14 +352,13 @@ TESTCASES_EVAL_CONDITION = [
     TESTCASES_EVAL_CONDITION
 )
 def test_eval_condition_versions(
-        condition, hmc_version_str, se_version_str, exp_result):
+        faked_client, condition, hmc_version_str, se_version_str, exp_result):
+    # pylint: disable=redefined-outer-name
     """
     Tests eval_condition() with hmc_version and se_version variables.
     """
 
-    session = setup_faked_session()
-    client = zhmcclient.Client(session)
-    cpc = client.cpcs.find(name='cpc_1')
+    cpc = faked_client.cpcs.find(name='cpc_1')
 
     # Arbitrary values for these variables, since we are not testing that here:
     hmc_api_version = (4, 10)
@@ -200,13 +376,12 @@ def test_eval_condition_versions(
     assert result == exp_result
 
 
-def test_eval_condition_resource():
+def test_eval_condition_resource(faked_client):
+    # pylint: disable=redefined-outer-name
     """
     Tests eval_condition() with resource_obj variable.
     """
-    session = setup_faked_session()
-    client = zhmcclient.Client(session)
-    cpc = client.cpcs.find(name='cpc_1')
+    cpc = faked_client.cpcs.find(name='cpc_1')
 
     # Arbitrary values for these variables, since we are not testing that here:
     hmc_version = (2, 16, 0)
@@ -226,11 +401,28 @@ def test_eval_condition_resource():
     assert result == 'cpc_1'
 
 
+def test_compile_condition():
+    """Tests that compile_condition() converts and caches conditions."""
+    code1 = zhmc_prometheus_exporter.compile_condition(
+        "hmc_version >= '2.14'")
+    code2 = zhmc_prometheus_exporter.compile_condition(
+        "hmc_version >= '2.14'")
+    assert code2 is code1
+    # pylint: disable=eval-used
+    assert eval(code1, {'hmc_version': (2, 14, 0)})  # nosec: B307
+
+
 TESTCASES_EVAL_CONDITION_ERROR = [
     # (condition, warn_msg_pattern)
-    ('dir()', "NameError: name 'dir' is not defined"),
-    ('builtins.dir()', "NameError: name 'builtins' is not defined"),
-    ('__builtins__["dir"]', "KeyError: 'dir'"),
+    ('dir()', "ValueError: Call expressions are not supported"),
+    ('builtins.dir()', "ValueError: Call expressions are not supported"),
+    ('__builtins__["dir"]', "ValueError: Name '__builtins__' is not supported"),
+    ('resource_obj.__class__', "ValueError: Name '__class__' is not supported"),
+    ('[x for x in hmc_features]',
+     "ValueError: ListComp expressions are not supported"),
+    ('hmc_version >=', "SyntaxError: "),
+    ('dir', "NameError: name 'dir' is not defined"),
+    ('hmc_features[0]', "IndexError: list index out of range"),
 ]
 
 
@@ -238,13 +430,12 @@ TESTCASES_EVAL_CONDITION_ERROR = [
     "condition, warn_msg_pattern",
     TESTCASES_EVAL_CONDITION_ERROR
 )
-def test_eval_condition_error(condition, warn_msg_pattern):
+def test_eval_condition_error(faked_client, condition, warn_msg_pattern):
+    # pylint: disable=redefined-outer-name
     """
     Tests eval_condition() with evaluation errors.
     """
-    session = setup_faked_session()
-    client = zhmcclient.Client(session)
-    cpc = client.cpcs.find(name='cpc_1')
+    cpc = faked_client.cpcs.find(name='cpc_1')
 
     # Arbitrary values for these variables, since we are not testing that here:
     hmc_version = (2, 16, 0)
@@ -267,6 +458,51 @@ def test_eval_condition_error(condition, warn_msg_pattern):
     assert re.search(warn_msg_pattern, str(warn_record.message))
 
 
+TESTCASES_LOGPRINT = [
+    # Testcases for test_logprint()
+    # Each list item is a testcase with the following tuple items:
+    # - message (str): Input message.
+    # - args (tuple): Input args.
+    # - exp_output (str): Expected printed output.
+    ("Finding resource for /api/cpcs/1", (),
+     "Finding resource for /api/cpcs/1\n"),
+    ("Finding resource for %s", ("/api/cpcs/1",),
+     "Finding resource for /api/cpcs/1\n"),
+    ("NIC %s.%s", ("cpc_1", "nic_1"),
+     "NIC cpc_1.nic_1\n"),
+    ("Percent sign without args: 100%", (),
+     "Percent sign without args: 100%\n"),
+]
+
+
+@pytest.mark.parametrize(
+    "message, args, exp_output",
+    TESTCASES_LOGPRINT
+)
+def test_logprint(capsys, monkeypatch, message, args, exp_output):
+    """
+    Tests logprint() with and without formatting args.
+    """
+    monkeypatch.setattr(zhmc_prometheus_exporter, 'VERBOSE_LEVEL', 1)
+
+    # The code to be tested
+    zhmc_prometheus_exporter.logprint(None, 1, message, *args)
+
+    captured = capsys.readouterr()
+    assert captured.out == exp_output
+
+
+def test_compile_jinja2_expression():
+    """Tests that compile_jinja2_expression() caches compiled expressions."""
+    env = zhmc_prometheus_exporter.JINJA2_ENV
+    func1 = zhmc_prometheus_exporter.compile_jinja2_expression(
+        env, "hmc_info.version")
+    func2 = zhmc_prometheus_exporter.compile_jinja2_expression(
+        env, "hmc_info.version")
+    assert func2 is func1
+    assert func1(hmc_info={'version': '2.15.0'}) == '2.15.0'
+
+
 # Fake HMC derived from
 # github.com/zhmcclient/python-zhmcclient/zhmcclient_mock/_hmc.py
 class TestCreateContext(unittest.TestCase):
@@ -293,13 +529,49 @@ class TestCreateContext(unittest.TestCase):
         context, _, _ = zhmc_prometheus_exporter.create_metrics_context(
             session, config_dict, yaml_metric_groups, hmc_version,
             hmc_api_version, hmc_features)
-        # pylint: disable=protected-access
-        self.assertEqual(type(context), zhmcclient._metrics.MetricsContext)
+        self.assertIsInstance(context, zhmcclient.MetricsContext)
         context.delete()
         session.logoff()
 
+    def test_exported_metric_groups(self):
+        """Tests get_exported_metric_groups() for HMC and resource groups."""
+        config_dict = {
+            "metric_groups": {
+                "dpm-system-usage-overview": {"export": True},
+                "cpc-resource": {"export": True},
+                "partition-resource": {"export": False},
+            }
+        }
+        yaml_metric_groups = {
+            "dpm-system-usage-overview": {"prefix": "pre"},
+            "cpc-resource": {
+                "type": "resource", "resource": "cpc", "prefix": "cpc"},
+            "partition-resource": {
+                "type": "resource", "resource": "cpc.partition",
+                "prefix": "partition"},
+        }
+        hmc_mgs, res_mgs, need_cpcs = \
+            zhmc_prometheus_exporter.get_exported_metric_groups(
+                config_dict, yaml_metric_groups, TEST_HMC_VERSION,
+                TEST_HMC_API_VERSION, TEST_HMC_FEATURES)
+        self.assertEqual(hmc_mgs, ["dpm-system-usage-overview"])
+        self.assertEqual(
+            res_mgs,
+            [("cpc-resource", zhmc_prometheus_exporter.list_cpc_items)])
+        self.assertTrue(need_cpcs)
+
+    @unittest.skipUnless(os.environ.get("ZHMC_SLOW_TESTS"),
+                         "slow network timeout test; set ZHMC_SLOW_TESTS=1 "
+                         "to run it")
     def test_timeout(self):
-        """Tests a timeout with an IP where no HMC is sitting."""
+        """
+        Tests a timeout with an IP where no HMC is sitting.
+
+        Depending on the network, this test may wait for the connect timeout
+        and retries, so it runs only if the ZHMC_SLOW_TESTS environment
+        variable is set. test_connection_error() covers the same error path
+        without network access.
+        """
 
         hmc_version = '2.14.1'
         hmc_api_version = (2, 37)
@@ -323,6 +595,245 @@ class TestCreateContext(unittest.TestCase):
                 session, config_dict, yaml_metric_groups, hmc_version,
                 hmc_api_version, hmc_features)
 
+    def test_connection_error(self):
+        """Tests a connection error when creating the metrics context."""
+
+        hmc_version = '2.14.1'
+        hmc_api_version = (2, 37)
+        hmc_features = []
+        config_dict = {
+            "hmcs": [
+                {"host": "192.168.0.0", "userid": "user", "password": "pwd"}
+            ],
+            "metric_groups": {}
+        }
+        session = zhmc_prometheus_exporter.create_session(
+            config_dict, "filename")
+        yaml_metric_groups = {}
+        conn_exc = zhmcclient.ConnectionError("Connect timeout", None)
+        with mock.patch.object(zhmcclient.Session, 'post',
+                               side_effect=conn_exc):
+            with self.assertRaises(zhmcclient.ConnectionError):
+                zhmc_prometheus_exporter.create_metrics_context(
+                    session, config_dict, yaml_metric_groups, hmc_version,
+                    hmc_api_version, hmc_features)
+
+
+class TestListPerCpc(unittest.TestCase):
+    """Tests list_per_cpc() and pull_full_properties()."""
+
+    def test_list_per_cpc(self):
+        # pylint: disable=no-self-use
+        """Tests that the results are returned in the order of the CPCs."""
+        session = setup_faked_dpm_session(num_cpcs=3)
+        client = zhmcclient.Client(session)
+        cpcs = client.cpcs.list()
+
+        result = zhmc_prometheus_exporter.list_per_cpc(
+            cpcs, lambda cpc: cpc.partitions.list())
+
+        assert [cpc.name for cpc, _ in result] == [cpc.name for cpc in cpcs]
+        for cpc, partitions in result:
+            assert [p.name for p in partitions] == \
+                [cpc.name.replace('cpc', 'part')]
+
+    def test_pull_full_properties(self):
+        # pylint: disable=no-self-use
+        """Tests that pull_full_properties() retrieves all resources."""
+        session = setup_faked_dpm_session(num_cpcs=3)
+        client = zhmcclient.Client(session)
+        cpcs = client.cpcs.list()
+        assert not any(cpc.full_properties for cpc in cpcs)
+
+        zhmc_prometheus_exporter.pull_full_properties(cpcs)
+
+        assert all(cpc.full_properties for cpc in cpcs)
+
+
+class TestGetBackingAdapterInfo(unittest.TestCase):
+    """Tests get_backing_adapter_info()."""
+
+    def test_shared_vswitch(self):
+        # pylint: disable=no-self-use
+        """Tests that a shared virtual switch is retrieved only once."""
+        session = setup_faked_dpm_session()
+        client = zhmcclient.Client(session)
+        partition = client.cpcs.find(name='cpc_1').partitions.find(
+            name='part_1')
+        nics = partition.nics.list(full_properties=True)
+
+        get_uris = []
+        org_get = session.get
+
+        def counting_get(uri, *args, **kwargs):
+            get_uris.append(uri)
+            return org_get(uri, *args, **kwargs)
+
+        session.get = counting_get
+        props_by_uri = {}
+        for nic in nics:
+
+            # The code to be tested
+            info = zhmc_prometheus_exporter.get_backing_adapter_info(
+                nic, props_by_uri)
+
+            assert info == ('osa_1', 1)
+
+        assert sorted(get_uris) == \
+            ['/api/adapters/osa_1', '/api/virtual-switches/vswitch_1']
+
+
+class TestResourceCache(unittest.TestCase):
+    """Tests ResourceCache."""
+
+    @classmethod
+    def setUpClass(cls):
+        # The tests only read from the faked HMC, so they can share it
+        cls.client = zhmcclient.Client(setup_faked_session())
+
+    def test_resource_cached(self):
+        """Tests that a resource is looked up only on the first access."""
+        cpc = self.client.cpcs.find(name='cpc_1')
+
+        lookups = []
+
+        class FakeObjectValue:
+            # pylint: disable=too-few-public-methods
+            """Metric object value that counts the resource lookups."""
+            @property
+            def resource(self):
+                """The resource, counting the lookup."""
+                lookups.append(cpc.uri)
+                return cpc
+
+        cache = zhmc_prometheus_exporter.ResourceCache()
+        for _ in range(3):
+            res = cache.resource(cpc.uri, FakeObjectValue())
+            assert res is cpc
+        assert lookups == [cpc.uri]
+
+        cache.remove(cpc.uri)
+        cache.remove(cpc.uri)  # Removing a non-cached URI is tolerated
+        res = cache.resource(cpc.uri, FakeObjectValue())
+        assert res is cpc
+        assert lookups == [cpc.uri, cpc.uri]
+
+    def test_resource_concurrent(self):
+        """
+        Tests that threads that miss the cache for the same URI at the same
+        time all get the resource object that was added first.
+        """
+        cpc_uri = self.client.cpcs.find(name='cpc_1').uri
+        num_threads = 8
+
+        # All threads wait in the lookup until all of them have missed the
+        # cache, and each lookup returns a different resource object.
+        barrier = threading.Barrier(num_threads)
+        client = self.client
+
+        class FakeObjectValue:
+            # pylint: disable=too-few-public-methods
+            """Metric object value whose lookup waits for all threads."""
+            @property
+            def resource(self):
+                """A new resource object, after all threads got here."""
+                barrier.wait(timeout=10)
+                return client.cpcs.resource_object(cpc_uri)
+
+        cache = zhmc_prometheus_exporter.ResourceCache()
+        results = [None] * num_threads
+
+        def lookup(index):
+            results[index] = cache.resource(cpc_uri, FakeObjectValue())
+
+        threads = [threading.Thread(target=lookup, args=(i,))
+                   for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cached = cache.resource(cpc_uri, FakeObjectValue())
+        for res in results:
+            assert res is cached
+
+    def test_cpc_cached(self):
+        """Tests that the CPC of a resource is determined and cached."""
+        cpc = self.client.cpcs.find(name='cpc_1')
+        console = self.client.consoles.console
+
+        cache = zhmc_prometheus_exporter.ResourceCache()
+        assert cache.cpc(cpc) is cpc
+        assert cache.cpc(console) is None
+        assert cache.cpc(console) is None  # From the cache
+
+
+class TestUriToResource(unittest.TestCase):
+    """Tests uri_to_resource()."""
+
+    @classmethod
+    def setUpClass(cls):
+        # The tests only read from the faked HMC, so they can share it
+        session = setup_faked_dpm_session()
+        cls.client = zhmcclient.Client(session)
+
+    def test_new_resources(self):
+        """Tests resources that are not yet in uri2resource."""
+        uri2resource = {}
+
+        nic_uri = "/api/partitions/part_1/nics/nic_1"
+        nic = zhmc_prometheus_exporter.uri_to_resource(
+            self.client, uri2resource, nic_uri)
+        self.assertEqual(nic.uri, nic_uri)
+        self.assertEqual(nic.manager.parent.uri, "/api/partitions/part_1")
+
+        cpc_uri = "/api/cpcs/cpc_1"
+        cpc = zhmc_prometheus_exporter.uri_to_resource(
+            self.client, uri2resource, cpc_uri)
+        self.assertEqual(cpc.uri, cpc_uri)
+
+        self.assertEqual(uri2resource, {nic_uri: nic, cpc_uri: cpc})
+        self.assertIs(zhmc_prometheus_exporter.uri_to_resource(
+            self.client, uri2resource, cpc_uri), cpc)
+
+    def test_unsupported_uri(self):
+        """Tests URIs of resource types that are not supported."""
+        for uri in ("/api/partitions/part_1",
+                    "/api/adapters/a1/network-ports/0",
+                    "/apix/cpcs/cpc_1",
+                    "/api/cpcs/cpc_1/extra",
+                    "/api/cpcs/",
+                    "/api/storage-groups/",
+                    "/api/partitions//nics/",
+                    "/api/partitions/part_1/nics/",
+                    "/api/partitions//nics/nic_1",
+                    "cpc_1"):
+            with self.subTest(uri=uri):
+                with self.assertRaises(zhmc_prometheus_exporter.OtherError):
+                    zhmc_prometheus_exporter.uri_to_resource(
+                        self.client, {}, uri)
+
+
+class TestCpcFromResource(unittest.TestCase):
+    """Tests cpc_from_resource()."""
+
+    def test_cpc_from_resource(self):
+        """Tests resources at different levels below a CPC and a console."""
+        session = setup_faked_dpm_session()
+        client = zhmcclient.Client(session)
+        cpc = client.cpcs.find(name='cpc_1')
+        partition = cpc.partitions.find(name='part_1')
+        nic = partition.nics.find(name='nic_1')
+        adapter = cpc.adapters.find(name='osa_1')
+        port = adapter.ports.find(name='port_0')
+        console = client.consoles.console
+
+        for resource in (cpc, partition, nic, adapter, port):
+            self.assertIs(
+                zhmc_prometheus_exporter.cpc_from_resource(resource), cpc)
+        self.assertIsNone(zhmc_prometheus_exporter.cpc_from_resource(console))
+        self.assertIsNone(zhmc_prometheus_exporter.cpc_from_resource(None))
+
 
 class TestCleanup(unittest.TestCase):
     """Tests cleanup."""
@@ -357,20 +868,86 @@ def setup_faked_session():
         zhmcclient_mock.FakedMetricObjectValues(
             group_name="dpm-system-usage-overview",
             resource_uri="/api/cpcs/cpc_1",
-            timestamp=datetime.datetime.now(),
-            values=[
-                ("processor-usage", 1),
-                ("network-usage", 2),
-                ("storage-usage", 3),
-                ("accelerator-usage", 4),
-                ("crypto-usage", 5),
-                ("power-consumption-watts", 100),
-                ("temperature-celsius", 10),
-                ("cp-shared-processor-usage", 1),
-                ("cp-dedicated-processor-usage", 2),
-                ("ifl-shared-processor-usage", 3),
-                ("ifl-dedicated-processor-usage", 4),
-            ]))
+            timestamp=TEST_METRICS_TIMESTAMP,
+            values=list(TEST_DPM_METRIC_VALUES)))
+    return session
+
+
+def setup_faked_dpm_session(num_cpcs=1):
+    """
+    Create a faked session with a console and DPM mode CPCs cpc_1 to
+    cpc_{num_cpcs}.
+
+    Each CPC cpc_{i} has an OSA adapter osa_{i} with port 0, a virtual switch
+    vswitch_{i} backed by port 1 of that adapter, and a partition part_{i}
+    with the NICs nic_1 and nic_2 that are connected to that virtual switch.
+    """
+
+    session = zhmcclient_mock.FakedSession("fake-host", "fake-hmc",
+                                           "2.13.1", "1.8")
+    session.hmc.add_resources({
+        "cpcs": [
+            {
+                "properties": {
+                    "name": f"cpc_{i}",
+                    "object-id": f"cpc_{i}",
+                    "object-uri": f"/api/cpcs/cpc_{i}",
+                    "dpm-enabled": True,
+                },
+                "adapters": [{
+                    "properties": {
+                        "name": f"osa_{i}",
+                        "object-id": f"osa_{i}",
+                        "object-uri": f"/api/adapters/osa_{i}",
+                        "type": "osd",
+                        "adapter-family": "osa",
+                    },
+                    "ports": [{
+                        "properties": {
+                            "name": "port_0",
+                            "element-id": "0",
+                            "element-uri":
+                                f"/api/adapters/osa_{i}/network-ports/0",
+                        },
+                    }],
+                }],
+                "virtual_switches": [{
+                    "properties": {
+                        "name": f"vswitch_{i}",
+                        "object-id": f"vswitch_{i}",
+                        "object-uri": f"/api/virtual-switches/vswitch_{i}",
+                        "backing-adapter-uri": f"/api/adapters/osa_{i}",
+                        "port": 1,
+                    },
+                }],
+                "partitions": [{
+                    "properties": {
+                        "name": f"part_{i}",
+                        "object-id": f"part_{i}",
+                        "object-uri": f"/api/partitions/part_{i}",
+                    },
+                    "nics": [
+                        {
+                            "properties": {
+                                "name": f"nic_{j}",
+                                "element-id": f"nic_{j}",
+                                "element-uri":
+                                    f"/api/partitions/part_{i}/nics/nic_{j}",
+                                "virtual-switch-uri":
+                                    f"/api/virtual-switches/vswitch_{i}",
+                            },
+                        } for j in range(1, 3)
+                    ],
+                }],
+            } for i in range(1, num_cpcs + 1)
+        ],
+        "consoles": [{
+            "properties": {
+                "name": "hmc_1",
+                "object-uri": "/api/console",
+            },
+        }],
+    })
     return session
 
 
@@ -412,19 +989,7 @@ class TestMetrics(unittest.TestCase):
         assert len(mgv.object_values) == 1
         ov = mgv.object_values[0]
         assert ov.resource.name == 'cpc_1'
-        assert ov.metrics == {
-            'processor-usage': 1,
-            'network-usage': 2,
-            'storage-usage': 3,
-            'accelerator-usage': 4,
-            'crypto-usage': 5,
-            'power-consumption-watts': 100,
-            'temperature-celsius': 10,
-            'cp-shared-processor-usage': 1,
-            'cp-dedicated-processor-usage': 2,
-            'ifl-shared-processor-usage': 3,
-            'ifl-dedicated-processor-usage': 4,
-        }
+        assert ov.metrics == dict(TEST_DPM_METRIC_VALUES)
 
         teardown_metrics_context(context)
 
@@ -458,19 +1023,15 @@ class TestMetrics(unittest.TestCase):
             }
         }
         extra_labels = {"label1": "value1"}
-        hmc_version = '2.15.0'
-        hmc_api_version = (3, 13)
-        hmc_features = []
-        se_versions_by_cpc = {'cpc_1': '2.15.0'}
-        se_features_by_cpc = {'cpc_1': []}
 
         session, context, resources = setup_metrics_context()
         metrics_object = zhmc_prometheus_exporter.retrieve_metrics(context)
 
         families = zhmc_prometheus_exporter.build_family_objects(
             metrics_object, yaml_metric_groups, yaml_metrics,
-            extra_labels, hmc_version, hmc_api_version, hmc_features,
-            se_versions_by_cpc, se_features_by_cpc, session)
+            extra_labels, TEST_HMC_VERSION, TEST_HMC_API_VERSION,
+            TEST_HMC_FEATURES, TEST_SE_VERSIONS_BY_CPC,
+            TEST_SE_FEATURES_BY_CPC, session)
 
         assert len(families) == 1
         assert "zhmc_pre_processor_usage" in families
@@ -491,8 +1052,9 @@ class TestMetrics(unittest.TestCase):
 
         families = zhmc_prometheus_exporter.build_family_objects_res(
             resources, yaml_metric_groups, yaml_metrics,
-            extra_labels, hmc_version, hmc_api_version, hmc_features,
-            se_versions_by_cpc, se_features_by_cpc, session)
+            extra_labels, TEST_HMC_VERSION, TEST_HMC_API_VERSION,
+            TEST_HMC_FEATURES, TEST_SE_VERSIONS_BY_CPC,
+            TEST_SE_FEATURES_BY_CPC, session)
 
         assert len(families) == 1
         assert "zhmc_foo_name" in families
@@ -517,111 +1079,50 @@ class TestMetrics(unittest.TestCase):
 class TestInitZHMCUsageCollector(unittest.TestCase):
     """Tests ZHMCUsageCollector."""
 
-    def test_init(self):
-        """Tests ZHMCUsageCollector.__init__."""
-
-        hmc_version = '2.15.0'
-        hmc_api_version = (3, 13)
-        hmc_features = []
-        se_versions_by_cpc = {'cpc_1': '2.15.0'}
-        se_features_by_cpc = {'cpc_1': []}
-
-        session = setup_faked_session()
-        config_dict = {
-            "hmcs": [
-                {"host": "192.168.0.0", "userid": "user", "password": "pwd"}
-            ],
-            "metric_groups": {
-                "dpm-system-usage-overview": {"export": True},
-            }
-        }
-        yaml_metric_groups = {
-            "dpm-system-usage-overview": {"prefix": "pre"},
-        }
-        context, resources, _ = \
+    @classmethod
+    def setUpClass(cls):
+        # The collector is created once and shared by the tests, which only
+        # read its attributes or collect from it
+        cls.session = setup_faked_session()
+        cls.context, resources, _ = \
             zhmc_prometheus_exporter.create_metrics_context(
-                session, config_dict, yaml_metric_groups, hmc_version,
-                hmc_api_version, hmc_features)
-        yaml_metrics = {
-            "dpm-system-usage-overview": {
-                "processor-usage": {
-                    "percent": True,
-                    "exporter_name": "processor_usage",
-                    "exporter_desc": "processor_usage description"
-                }
-            }
-        }
-        yaml_fetch_properties = {
-            "cpc": [
-                {"property_name": "processor-count-spare"},
-            ],
-        }
+                cls.session, TEST_CONFIG_DICT, TEST_YAML_METRIC_GROUPS,
+                TEST_HMC_VERSION, TEST_HMC_API_VERSION, TEST_HMC_FEATURES)
         extra_labels = {}
+        cls.collector = zhmc_prometheus_exporter.ZHMCUsageCollector(
+            TEST_CONFIG_DICT, cls.session, cls.context, resources,
+            TEST_YAML_METRIC_GROUPS, TEST_YAML_METRICS,
+            TEST_YAML_FETCH_PROPERTIES, extra_labels, "filename", "filename",
+            None, None, TEST_HMC_VERSION, TEST_HMC_API_VERSION,
+            TEST_HMC_FEATURES, TEST_SE_VERSIONS_BY_CPC,
+            TEST_SE_FEATURES_BY_CPC)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.context.delete()
 
-        my_zhmc_usage_collector = zhmc_prometheus_exporter.ZHMCUsageCollector(
-            config_dict, session, context, resources, yaml_metric_groups,
-            yaml_metrics, yaml_fetch_properties, extra_labels, "filename",
-            "filename", None, None, hmc_version, hmc_api_version, hmc_features,
-            se_versions_by_cpc, se_features_by_cpc)
-        self.assertEqual(my_zhmc_usage_collector.config_dict, config_dict)
-        self.assertEqual(my_zhmc_usage_collector.session, session)
-        self.assertEqual(my_zhmc_usage_collector.context, context)
+    def test_init(self):
+        """Tests ZHMCUsageCollector.__init__."""
+
+        my_zhmc_usage_collector = self.collector
+        self.assertEqual(my_zhmc_usage_collector.config_dict, TEST_CONFIG_DICT)
+        self.assertEqual(my_zhmc_usage_collector.session, self.session)
+        self.assertEqual(my_zhmc_usage_collector.context, self.context)
         self.assertEqual(my_zhmc_usage_collector.yaml_metric_groups,
-                         yaml_metric_groups)
-        self.assertEqual(my_zhmc_usage_collector.yaml_metrics, yaml_metrics)
+                         TEST_YAML_METRIC_GROUPS)
+        self.assertEqual(my_zhmc_usage_collector.yaml_metrics,
+                         TEST_YAML_METRICS)
         self.assertEqual(my_zhmc_usage_collector.metrics_filename, "filename")
         self.assertEqual(my_zhmc_usage_collector.config_filename, "filename")
 
     def test_collect(self):
         """Test ZHMCUsageCollector.collect"""
 
-        hmc_version = '2.15.0'
-        hmc_api_version = (3, 13)
-        hmc_features = []
-        se_versions_by_cpc = {'cpc_1': '2.15.0'}
-        se_features_by_cpc = {'cpc_1': []}
-
-        session = setup_faked_session()
-        config_dict = {
-            "hmcs": [
-                {"host": "192.168.0.0", "userid": "user", "password": "pwd"}
-            ],
-            "metric_groups": {
-                "dpm-system-usage-overview": {"export": True},
-            }
-        }
-        yaml_metric_groups = {
-            "dpm-system-usage-overview": {"prefix": "pre"},
-        }
-        context, resources, _ = \
-            zhmc_prometheus_exporter.create_metrics_context(
-                session, config_dict, yaml_metric_groups, hmc_version,
-                hmc_api_version, hmc_features)
-        yaml_metrics = {
-            "dpm-system-usage-overview": {
-                "processor-usage": {
-                    "percent": True,
-                    "exporter_name": "processor_usage",
-                    "exporter_desc": "processor_usage description"
-                }
-            }
-        }
-        yaml_fetch_properties = {
-            "cpc": [
-                {"property_name": "processor-count-spare"},
-            ],
-        }
-        extra_labels = {}
-
-        my_zhmc_usage_collector = zhmc_prometheus_exporter.ZHMCUsageCollector(
-            config_dict, session, context, resources, yaml_metric_groups,
-            yaml_metrics, yaml_fetch_properties, extra_labels, "filename",
-            "filename", None, None, hmc_version, hmc_api_version, hmc_features,
-            se_versions_by_cpc, se_features_by_cpc)
+        my_zhmc_usage_collector = self.collector
         collected = list(my_zhmc_usage_collector.collect())
         self.assertEqual(len(collected), 1)
-        self.assertEqual(type(collected[0]),
-                         prometheus_client.core.GaugeMetricFamily)
+        self.assertIsInstance(collected[0],
+                              prometheus_client.core.GaugeMetricFamily)
         self.assertEqual(collected[0].name, "zhmc_pre_processor_usage")
         self.assertEqual(collected[0].documentation,
                          "processor_usage description")
@@ -633,22 +1134,37 @@ class TestInitZHMCUsageCollector(unittest.TestCase):
         # pylint: disable=protected-access
         self.assertEqual(collected[0]._labelnames, ("resource",))
 
+    def test_collect_many_metrics(self):
+        """Test ZHMCUsageCollector.collect with a growing number of metrics"""
+
+        metric_names = [name for name, _ in TEST_DPM_METRIC_VALUES]
+        for num_metrics in (1, 5, len(metric_names)):
+            with self.subTest(num_metrics=num_metrics):
+                yaml_metrics = {
+                    "dpm-system-usage-overview": {
+                        name: {
+                            "exporter_name": name.replace('-', '_'),
+                            "exporter_desc": f"{name} description",
+                        }
+                        for name in metric_names[:num_metrics]
+                    }
+                }
+                with mock.patch.object(
+                        self.collector, 'yaml_metrics', yaml_metrics):
+                    collected = list(self.collector.collect())
+                self.assertEqual(len(collected), num_metrics)
 
-class TestResourceStr(unittest.TestCase):
-    """Tests resource_str()."""
 
-    def test_resource_str(self):
-        # pylint: disable=no-self-use
-        """Tests resource_str()."""
+def test_resource_str(faked_client):
+    # pylint: disable=redefined-outer-name
+    """Tests resource_str()."""
 
-        session = setup_faked_session()
-        client = zhmcclient.Client(session)
-        cpc1 = client.cpcs.list(
-            full_properties=True, filter_args={'name': 'cpc_1'})[0]
+    cpc1 = faked_client.cpcs.list(
+        full_properties=True, filter_args={'name': 'cpc_1'})[0]
 
-        rs_cpc1 = zhmc_prometheus_exporter.resource_str(cpc1)
+    rs_cpc1 = zhmc_prometheus_exporter.resource_str(cpc1)
 
-        assert rs_cpc1 == "CPC 'cpc_1'"
+    assert rs_cpc1 == "CPC 'cpc_1'"
 
 
 if __name__ == "__main__":
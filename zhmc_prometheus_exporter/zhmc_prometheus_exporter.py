@@ -19,29 +19,45 @@ IBM Z HMC Prometheus Exporter
 """
 
 import argparse
+import ast
 import sys
 import os
+import pathlib
 import types
 import platform
 import re
+import signal
 import time
 from datetime import datetime
 import warnings
 import logging
-import logging.handlers
 import traceback
 import threading
+import copy
+import functools
+from collections import OrderedDict
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import jinja2
 import urllib3
 from ruamel.yaml import YAML, YAMLError
-import jsonschema
+from yaml import load as pyyaml_load, YAMLError as PyYAMLError
+try:
+    # PyYAML with the libyaml C extension
+    from yaml import CSafeLoader as PyYAMLSafeLoader
+except ImportError:
+    from yaml import SafeLoader as PyYAMLSafeLoader
 import zhmcclient
-
-from .vendor.prometheus_client import start_http_server
-from .vendor.prometheus_client.core import GaugeMetricFamily, \
-    CounterMetricFamily, REGISTRY
+try:
+    from importlib.resources import files as resource_files
+except ImportError:
+    # importlib.resources.files() was added in Python 3.9
+    resource_files = None
+
+# The vendored prometheus_client package and jsonschema are imported only where
+# they are used, so that the --version and --help-config options do not pay for
+# importing them.
 from .vendor import prometheus_client_version
 from ._version import __version__
 
@@ -109,6 +125,26 @@ FETCH_HYSTERESIS = 10
 # Sleep time in seconds when retrying metrics retrieval
 RETRY_SLEEP_TIME = 10
 
+# Maximum number of threads for retrieving resources from the HMC
+# concurrently
+MAX_LIST_WORKERS = 8
+
+# Maximum number of parsed YAML files kept in the cache of parse_yaml_file()
+YAML_CACHE_SIZE = 100
+
+# Cache of parse_yaml_file() for parsed and validated YAML files.
+# Key: tuple(abs_path, mtime_ns, size, schemafilename, round_trip), as
+# returned by yaml_cache_key(). Value: Parsed YAML object.
+YAML_CACHE = OrderedDict()
+
+# Maximum number of compiled Jinja2 expressions kept in the cache of
+# compile_jinja2_expression()
+JINJA2_CACHE_SIZE = 1000
+
+# Jinja2 environment for the label value and properties expressions. It is
+# shared, so that the compiled expressions can be reused across scrapes.
+JINJA2_ENV = jinja2.Environment(autoescape=True)
+
 # Retry / timeout configuration for zhmcclient (used at the socket level)
 RETRY_TIMEOUT_CONFIG = zhmcclient.RetryTimeoutConfig(
     connect_timeout=10,
@@ -219,13 +255,16 @@ def parse_args(args):
 
     parser = argparse.ArgumentParser(
         description="IBM Z HMC Exporter - a Prometheus exporter for metrics "
-        "from the IBM Z HMC")
+        "from the IBM Z HMC",
+        epilog="Arguments may also be read from a file that is specified as "
+        "@FILE, with one argument per line.",
+        fromfile_prefix_chars='@')
     parser.add_argument("-c", metavar="CONFIG_FILE",
                         default=DEFAULT_CONFIG_FILE,
                         help="path name of exporter config file. "
                         "Use --help-config for details. "
                         f"Default: {DEFAULT_CONFIG_FILE}")
-    parser.add_argument("-p", metavar="PORT",
+    parser.add_argument("-p", metavar="PORT", type=int,
                         default=None,
                         help="port for exporting. Default: prometheus.port in "
                         "exporter config file")
@@ -398,80 +437,172 @@ def validate_option(option_name, option_value, allowed_values):
     return option_value
 
 
-def parse_yaml_file(yamlfile, name, schemafilename=None):
+def yaml_cache_key(yamlfile, schemafilename, round_trip=True):
     """
-    Returns the parsed content of a YAML file as a Python object.
-    Optionally validates against a specified JSON schema file in YAML format.
+    Return the key for the YAML file in YAML_CACHE, or None if the file
+    cannot be accessed.
+
+    The key includes the modification time and size of the file, so that a
+    changed file does not match a previously cached key.
+    """
+    try:
+        st = os.stat(yamlfile)
+    except OSError:
+        return None
+    return (os.path.abspath(yamlfile), st.st_mtime_ns, st.st_size,
+            schemafilename, round_trip)
+
+
+@functools.lru_cache(maxsize=None)
+def schema_validator(schemafilename):
+    """
+    Return a JSON schema validator for a JSON schema file in YAML format in the
+    'schemas' directory of this package.
+
+    The schema files are static, so the validators are cached. The set of
+    schema files is fixed, so the cache is not bounded.
 
     Raises:
         ImproperExit
     """
 
-    yaml = YAML(typ='rt')
+    import jsonschema  # pylint: disable=import-outside-toplevel
+
+    # The schema files are package data. Accessing them as resources of the
+    # package also works when the package is not installed as files.
+    if resource_files is not None:
+        schemafile = resource_files(__package__) / 'schemas' / schemafilename
+    else:
+        schemafile = pathlib.Path(__file__).parent / 'schemas' / schemafilename
     try:
-        with open(yamlfile, encoding='utf-8') as fp:
-            yaml_obj = yaml.load(fp)
+        with schemafile.open(encoding='utf-8') as fp:
+            # The schema files contain only plain data, so they are
+            # loaded with the faster PyYAML safe loader
+            schema = pyyaml_load(fp, Loader=PyYAMLSafeLoader)
     except FileNotFoundError as exc:
         new_exc = ImproperExit(
-            f"Cannot find {name} {yamlfile}: {exc}")
+            f"Internal error: Cannot find schema file {schemafile}: {exc}")
         new_exc.__cause__ = None  # pylint: disable=invalid-name
         raise new_exc
     except PermissionError as exc:
         new_exc = ImproperExit(
-            f"Permission error reading {name} {yamlfile}: {exc}")
+            "Internal error: Permission error reading schema file "
+            f"{schemafile}: {exc}")
         new_exc.__cause__ = None  # pylint: disable=invalid-name
         raise new_exc
-    except YAMLError as exc:
+    except PyYAMLError as exc:
         new_exc = ImproperExit(
-            f"YAML error reading {name} {yamlfile}: {exc}")
+            "Internal error: YAML error reading schema file "
+            f"{schemafile}: {exc}")
         new_exc.__cause__ = None  # pylint: disable=invalid-name
         raise new_exc
 
-    if schemafilename:
+    validator_class = jsonschema.validators.validator_for(schema)
+    try:
+        validator_class.check_schema(schema)
+    except jsonschema.exceptions.SchemaError as exc:
+        new_exc = ImproperExit(
+            f"Internal error: Invalid JSON schema file {schemafile}: "
+            f"{exc}")
+        new_exc.__cause__ = None
+        raise new_exc
+    return validator_class(schema)
 
-        yaml = YAML(typ='safe')
-        schemafile = os.path.join(
-            os.path.dirname(__file__), 'schemas', schemafilename)
-        try:
-            with open(schemafile, encoding='utf-8') as fp:
-                schema = yaml.load(fp)
-        except FileNotFoundError as exc:
-            new_exc = ImproperExit(
-                f"Internal error: Cannot find schema file {schemafile}: {exc}")
-            new_exc.__cause__ = None  # pylint: disable=invalid-name
-            raise new_exc
-        except PermissionError as exc:
-            new_exc = ImproperExit(
-                "Internal error: Permission error reading schema file "
-                f"{schemafile}: {exc}")
-            new_exc.__cause__ = None  # pylint: disable=invalid-name
-            raise new_exc
-        except YAMLError as exc:
-            new_exc = ImproperExit(
-                "Internal error: YAML error reading schema file "
-                f"{schemafile}: {exc}")
-            new_exc.__cause__ = None  # pylint: disable=invalid-name
-            raise new_exc
 
-        try:
-            jsonschema.validate(yaml_obj, schema)
-        except jsonschema.exceptions.SchemaError as exc:
-            new_exc = ImproperExit(
-                f"Internal error: Invalid JSON schema file {schemafile}: "
-                f"{exc}")
-            new_exc.__cause__ = None
-            raise new_exc
-        except jsonschema.exceptions.ValidationError as exc:
-            element_str = json_path_str(exc.absolute_path)
+def parse_yaml_stream(stream, name, schemafilename=None, round_trip=True):
+    """
+    Returns the parsed content of a YAML stream as a Python object.
+    Optionally validates against a specified JSON schema file in YAML format.
+
+    The stream may be an open file or an in-memory text stream. Its 'name'
+    attribute, if present, is used in error messages.
+
+    If round_trip is True, the stream is loaded with the ruamel.yaml round-trip
+    loader, so that the result can be written back with write_yaml_file()
+    while preserving comments and formatting. Otherwise, it is loaded as plain
+    data with the much faster PyYAML safe loader.
+
+    Raises:
+        ImproperExit
+    """
+
+    yamlfile = getattr(stream, 'name', '<stream>')
+
+    try:
+        if round_trip:
+            yaml_obj = YAML(typ='rt').load(stream)
+        else:
+            yaml_obj = pyyaml_load(stream, Loader=PyYAMLSafeLoader)
+    except (YAMLError, PyYAMLError) as exc:
+        new_exc = ImproperExit(
+            f"YAML error reading {name} {yamlfile}: {exc}")
+        new_exc.__cause__ = None  # pylint: disable=invalid-name
+        raise new_exc
+
+    if schemafilename:
+        import jsonschema  # pylint: disable=import-outside-toplevel
+        validator = schema_validator(schemafilename)
+        error = jsonschema.exceptions.best_match(
+            validator.iter_errors(yaml_obj))
+        if error is not None:
+            element_str = json_path_str(error.absolute_path)
             new_exc = ImproperExit(
                 f"Validation of {name} {yamlfile} failed on {element_str}: "
-                f"{exc.message}")
+                f"{error.message}")
             new_exc.__cause__ = None
             raise new_exc
 
     return yaml_obj
 
 
+def parse_yaml_file(yamlfile, name, schemafilename=None, round_trip=True):
+    """
+    Returns the parsed content of a YAML file as a Python object.
+    Optionally validates against a specified JSON schema file in YAML format.
+
+    For round_trip, see parse_yaml_stream().
+
+    Successfully parsed and validated files are cached in YAML_CACHE, so that
+    parsing an unchanged file again returns a copy of the cached object.
+
+    Raises:
+        ImproperExit
+    """
+
+    cache_key = yaml_cache_key(yamlfile, schemafilename, round_trip)
+    if cache_key is not None:
+        try:
+            yaml_obj = YAML_CACHE[cache_key]
+        except KeyError:
+            pass
+        else:
+            YAML_CACHE.move_to_end(cache_key)
+            # The caller may modify the returned object
+            return copy.deepcopy(yaml_obj)
+
+    try:
+        with open(yamlfile, encoding='utf-8') as fp:
+            yaml_obj = parse_yaml_stream(
+                fp, name, schemafilename, round_trip)
+    except FileNotFoundError as exc:
+        new_exc = ImproperExit(
+            f"Cannot find {name} {yamlfile}: {exc}")
+        new_exc.__cause__ = None  # pylint: disable=invalid-name
+        raise new_exc
+    except PermissionError as exc:
+        new_exc = ImproperExit(
+            f"Permission error reading {name} {yamlfile}: {exc}")
+        new_exc.__cause__ = None  # pylint: disable=invalid-name
+        raise new_exc
+
+    if cache_key is not None:
+        YAML_CACHE[cache_key] = copy.deepcopy(yaml_obj)
+        if len(YAML_CACHE) > YAML_CACHE_SIZE:
+            YAML_CACHE.popitem(last=False)
+
+    return yaml_obj
+
+
 def write_yaml_file(yaml_obj, yamlfile, name):
     """
     Write a YAML object into a YAML file, overwriting any existing file.
@@ -623,12 +754,8 @@ def json_path_str(path_list):
     if not path_list:
         return "root elements"
 
-    path_str = ""
-    for p in path_list:
-        if isinstance(p, int):
-            path_str += f"[{p}]"
-        else:
-            path_str += f".{p}"
+    path_str = "".join(
+        f"[{p}]" if isinstance(p, int) else f".{p}" for p in path_list)
     if path_str.startswith('.'):
         path_str = path_str[1:]
     return f"element '{path_str}'"
@@ -651,15 +778,11 @@ def split_version(version_str_, pad_to):
 
       tuple(int, ...): Tuple of version parts, as integers.
     """
-    version_info = []
-    for v in version_str_.strip('"\'').split('.'):
-        if v == '':
-            v = 0
-        vint = int(v)  # May raise ValueError
-        version_info.append(vint)
-    while len(version_info) < pad_to:
-        version_info.append(0)
-        pad_to -= 1
+    # int() may raise ValueError
+    version_info = [int(v) if v else 0
+                    for v in version_str_.strip('"\'').split('.')]
+    if len(version_info) < pad_to:
+        version_info.extend([0] * (pad_to - len(version_info)))
     return tuple(version_info)
 
 
@@ -681,8 +804,23 @@ def version_str(version_tuple):
 
 
 MNU_PATTERN = r'\d+(?:\.\d+(?:\.\d+)?)?'  # M.N.U
-COND_PATTERN = f'^(.*?)("{MNU_PATTERN}"|\'{MNU_PATTERN}\')(.*)$'
-COND_PATTERN = re.compile(COND_PATTERN)
+# Quoted 'M.N.U' version literal in a condition
+COND_PATTERN = re.compile(f'"{MNU_PATTERN}"|\'{MNU_PATTERN}\'')
+
+# Maximum number of compiled conditions kept in the cache of
+# compile_condition()
+COND_CACHE_SIZE = 1000
+
+# Python AST node types that are allowed in conditions
+COND_AST_NODES = (
+    ast.Expression, ast.BoolOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load,
+    ast.Attribute, ast.Subscript, ast.Constant, ast.Tuple, ast.List,
+    ast.And, ast.Or, ast.Not, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt,
+    ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot,
+)
+if sys.version_info < (3, 9):
+    # Subscripts have an additional Index node before Python 3.9
+    COND_AST_NODES += (ast.Index,)  # pylint: disable=no-member
 
 
 def resource_str(resource_obj):
@@ -694,13 +832,53 @@ def resource_str(resource_obj):
     if res_class == 'cpc':
         res_str = f"CPC '{resource_obj.name}'"
     elif res_class in ('partition', 'logical-partition'):
-        res_str = "partition '{}' on CPC '{}'". \
-            format(resource_obj.name, resource_obj.manager.parent.name)
+        res_str = f"partition '{resource_obj.name}' on CPC " \
+            f"'{resource_obj.manager.parent.name}'"
     else:
         raise ValueError(f"Resource class {res_class} is not supported")
     return res_str
 
 
+@functools.lru_cache(maxsize=COND_CACHE_SIZE)
+def compile_condition(condition):
+    """
+    Compile a condition expression and return the code object for evaluating
+    it.
+
+    Any M.N.U version strings in the condition expression are converted to a
+    tuple of integers before compiling the expression.
+
+    The condition expression may only use comparisons, boolean operators,
+    literals, variables, attributes and subscripts (see COND_AST_NODES).
+    Names and attributes beginning with an underscore are rejected.
+
+    The conditions in the metric definition file are evaluated for each
+    resource on each scrape, so the compiled conditions are cached.
+
+    Raises:
+        SyntaxError, ValueError
+    """
+    # Convert literal strings 'M.N.U' in condition to tuple syntax (M, N, U)
+    condition = COND_PATTERN.sub(
+        lambda m: str(split_version(m.group(0), 3)), condition)
+    tree = ast.parse(condition, '<condition>', 'eval')
+    for node in ast.walk(tree):
+        if not isinstance(node, COND_AST_NODES):
+            raise ValueError(
+                f"{node.__class__.__name__} expressions are not supported in "
+                "conditions")
+        if isinstance(node, ast.Name):
+            name = node.id
+        elif isinstance(node, ast.Attribute):
+            name = node.attr
+        else:
+            continue
+        if name.startswith('_'):
+            raise ValueError(
+                f"Name {name!r} is not supported in conditions")
+    return compile(tree, '<condition>', 'eval')
+
+
 def eval_condition(
         item_str, condition, hmc_version, hmc_api_version, hmc_features,
         se_version, se_features, resource_obj):
@@ -742,34 +920,23 @@ def eval_condition(
 
       bool: Evaluated condition
     """
-    org_condition = condition
     if se_features is None:
         se_features = []
     if hmc_features is None:
         hmc_features = []
 
-    # Convert literal strings 'M.N.U' in condition to tuple syntax (M, N, U)
-    while True:
-        m = COND_PATTERN.match(condition)
-        if m is None:
-            break
-        condition = "{}{}{}".format(
-            m.group(1), split_version(m.group(2), 3), m.group(3))
-
     # The variables that can be used in the expression
-    eval_vars = dict(
-        __builtins__={},
-        hmc_version=hmc_version,
-        hmc_api_version=hmc_api_version,
-        hmc_features=hmc_features,
-    )
+    eval_vars = {
+        '__builtins__': {},
+        'hmc_version': hmc_version,
+        'hmc_api_version': hmc_api_version,
+        'hmc_features': hmc_features,
+    }
     if resource_obj:
         # In an export-condition (not in a fetch-condition)
-        eval_vars.update(dict(
-            se_version=se_version,
-            se_features=se_features,
-            resource_obj=resource_obj,
-        ))
+        eval_vars['se_version'] = se_version
+        eval_vars['se_features'] = se_features
+        eval_vars['resource_obj'] = resource_obj
 
     # --- begin debug code - enable in case of issues with conditions
     # var_dict = dict(eval_vars)
@@ -781,13 +948,14 @@ def eval_condition(
     # --- end debug code
 
     try:
+        code = compile_condition(condition)
         # pylint: disable=eval-used
-        result = eval(condition, eval_vars, None)  # nosec: B307
+        result = eval(code, eval_vars, None)  # nosec: B307
     except Exception as exc:  # pylint: disable=broad-exception-caught
         tb_str = traceback.format_tb(exc.__traceback__, limit=-1)[0]
         warnings.warn(
             f"Not providing {item_str} because its condition "
-            f"{org_condition!r} does not properly evaluate: "
+            f"{condition!r} does not properly evaluate: "
             f"{exc.__class__.__name__}: {exc}\n{tb_str}")
         return False
 
@@ -862,33 +1030,184 @@ def get_hmc_info(session):
     return hmc_info
 
 
-def create_metrics_context(
-        session, config_dict, yaml_metric_groups, hmc_version,
-        hmc_api_version, hmc_features):
+def map_concurrently(func, items):
     """
-    Creating a context is mandatory for reading metrics from the Z HMC.
-    Takes the session, the metric_groups dictionary from the metrics YAML file
-    for fetch/do not fetch information, and the name of the YAML file for error
-    output.
+    Return the list of the results of func(item) for each of the items, in
+    the order of the items.
 
-    Returns a tuple(context, resources, uri2resource), where:
-      * context is the metric context
-      * resources is a dict(key: metric group name, value: list of
-        auto-enabled resource objects for the metric group).
-      * uri2resource is a dict(key: resource URI, value: auto-enabled resource
-        object for the URI).
+    The calls are performed concurrently on a thread pool of at most
+    MAX_LIST_WORKERS threads when there is more than one item, because each
+    of them is typically a separate HMC round trip.
+
+    Raises: Any exception raised by func
+    """
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    max_workers = min(len(items), MAX_LIST_WORKERS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, items))
+
+
+def list_per_cpc(cpcs, list_func):
+    """
+    Return the child resources of each CPC, as a list of tuple(cpc, resources)
+    where resources is the result of list_func(cpc).
+
+    The List operations for the CPCs are independent HMC round trips, so they
+    are performed concurrently when there is more than one CPC.
 
     Raises: zhmccclient exceptions
     """
-    config_mg_dict = config_dict["metric_groups"]
+    return list(zip(cpcs, map_concurrently(list_func, cpcs)))
+
+
+def pull_full_properties(resources):
+    """
+    Retrieve the full set of properties of each of the resources from the HMC.
+
+    If there are multiple resources, this is done concurrently, because each
+    resource requires a separate HMC operation.
+
+    Parameters:
+      resources (list of zhmcclient.BaseResource): The resources.
+
+    Raises: zhmccclient exceptions
+    """
+    map_concurrently(lambda res: res.pull_full_properties(), resources)
+
+
+def enable_auto_update(metric_group, resource, res_str):
+    """
+    Enable auto-update for a resource of a resource metric group.
+
+    Parameters:
+      metric_group (string): Name of the resource metric group, for messages.
+      resource (zhmcclient.BaseResource): The resource.
+      res_str (string): A string that identifies the resource, for messages.
+
+    Returns:
+      bool: Indicates whether auto-update was enabled for the resource. If
+      enabling it failed, an error has been logged and printed, and the
+      resource is to be skipped.
+    """
+    logprint(logging.INFO, PRINT_V,
+             "Enabling auto-update for %s", res_str)
+    try:
+        resource.enable_auto_update()
+    except zhmcclient.Error as exc:
+        logprint(logging.ERROR, PRINT_ALWAYS,
+                 f"Not providing metric group {metric_group!r} for {res_str}, "
+                 "because enabling auto-update for it failed with "
+                 f"{exc.__class__.__name__}: {exc}")
+        return False
+    return True
+
+
+def list_cpc_items(client, cpcs):
+    # pylint: disable=unused-argument
+    """
+    Return the resources for resource path 'cpc', as a list of
+    tuple(resource, res_str).
+    """
+    return [(cpc, f"CPC {cpc.name}") for cpc in cpcs]
+
+
+def list_partition_items(client, cpcs):
+    # pylint: disable=unused-argument
+    """
+    Return the resources for resource path 'cpc.partition', as a list of
+    tuple(resource, res_str).
+    """
+    return [
+        (partition, f"partition {cpc.name}.{partition.name}")
+        for cpc, partitions in list_per_cpc(
+            cpcs, lambda cpc: cpc.partitions.list())
+        for partition in partitions]
+
+
+def list_lpar_items(client, cpcs):
+    # pylint: disable=unused-argument
+    """
+    Return the resources for resource path 'cpc.logical-partition', as a list
+    of tuple(resource, res_str).
+    """
+    return [
+        (lpar, f"LPAR {cpc.name}.{lpar.name}")
+        for cpc, lpars in list_per_cpc(
+            cpcs, lambda cpc: cpc.lpars.list())
+        for lpar in lpars]
+
+
+def list_storagegroup_items(client, cpcs):
+    # pylint: disable=unused-argument
+    """
+    Return the resources for resource path 'console.storagegroup', as a list
+    of tuple(resource, res_str).
+    """
+    console = client.consoles.console
+    return [
+        (sg, f"storage group {sg.name}")
+        for sg in console.storage_groups.list()]
+
+
+def list_storagevolume_items(client, cpcs):
+    # pylint: disable=unused-argument
+    """
+    Return the resources for resource path 'console.storagevolume', as a list
+    of tuple(resource, res_str).
+    """
+    console = client.consoles.console
+    return [
+        (sv, f"storage volume {sg.name}.{sv.name}")
+        for sg in console.storage_groups.list()
+        for sv in sg.storage_volumes.list()]
+
+
+# Functions for listing the resources of resource metric groups, by the
+# 'resource' item of the metric group in the metric definition file. The
+# functions are called with (client, cpcs) and return a list of
+# tuple(resource, res_str).
+RESOURCE_LIST_FUNCS = {
+    'cpc': list_cpc_items,
+    'cpc.partition': list_partition_items,
+    'cpc.logical-partition': list_lpar_items,
+    'console.storagegroup': list_storagegroup_items,
+    'console.storagevolume': list_storagevolume_items,
+}
+
+
+def get_exported_metric_groups(
+        config_dict, yaml_metric_groups, hmc_version, hmc_api_version,
+        hmc_features):
+    """
+    Determine the metric groups to be exported, from the exporter config file
+    and the metric definition file.
+
+    Returns a tuple(exported_hmc_metric_groups, exported_res_metric_groups,
+    need_cpcs), where:
+      * exported_hmc_metric_groups is a list of the names of the exported HMC
+        metric groups.
+      * exported_res_metric_groups is a list of tuple(metric_group, list_func)
+        for the exported resource metric groups, where list_func is the
+        function from RESOURCE_LIST_FUNCS.
+      * need_cpcs is a boolean indicating whether the CPCs need to be listed
+        for the exported resource metric groups.
+
+    Raises: InvalidMetricDefinitionFile
+    """
+    # Names of the metric groups enabled for export in the exporter config
+    # file. Not all metric groups may be specified.
+    config_export_mgs = {
+        mg for mg, config_mg_item in config_dict["metric_groups"].items()
+        if config_mg_item.get("export", False)}
     exported_hmc_metric_groups = []
+    # List of tuple(metric_group, list_func) for the exported resource metric
+    # groups, where list_func is the function from RESOURCE_LIST_FUNCS
     exported_res_metric_groups = []
-    for metric_group in yaml_metric_groups:
-        mg_dict = yaml_metric_groups[metric_group]
+    need_cpcs = False
+    for metric_group, mg_dict in yaml_metric_groups.items():
         mg_type = mg_dict.get("type", 'hmc')
-        # Not all metric groups may be specified:
-        config_mg_item = config_mg_dict.get(metric_group, {})
-        export = config_mg_item.get("export", False)
+        export = metric_group in config_export_mgs
         # if is optional in the metrics schema:
         if export and "if" in mg_dict:
             export = eval_condition(
@@ -900,7 +1219,58 @@ def create_metrics_context(
                 exported_hmc_metric_groups.append(metric_group)
             else:
                 assert mg_type == 'resource'  # ensured by enum
-                exported_res_metric_groups.append(metric_group)
+                try:
+                    resource_path = mg_dict['resource']
+                except KeyError:
+                    new_exc = InvalidMetricDefinitionFile(
+                        "Missing 'resource' item in resource metric group "
+                        f"{metric_group} in the metric definition file")
+                    new_exc.__cause__ = None  # pylint: disable=invalid-name
+                    raise new_exc
+                try:
+                    list_func = RESOURCE_LIST_FUNCS[resource_path]
+                except KeyError:
+                    new_exc = InvalidMetricDefinitionFile(
+                        f"Unknown resource item {resource_path!r} in "
+                        f"resource metric group {metric_group!r} in the "
+                        "metric definition file.")
+                    new_exc.__cause__ = None  # pylint: disable=invalid-name
+                    raise new_exc
+                exported_res_metric_groups.append((metric_group, list_func))
+                if resource_path.startswith('cpc'):
+                    need_cpcs = True
+
+    return exported_hmc_metric_groups, exported_res_metric_groups, need_cpcs
+
+
+def create_metrics_context(
+        session, config_dict, yaml_metric_groups, hmc_version,
+        hmc_api_version, hmc_features, exported_metric_groups=None):
+    """
+    Creating a context is mandatory for reading metrics from the Z HMC.
+    Takes the session, the metric_groups dictionary from the metrics YAML file
+    for fetch/do not fetch information, and the name of the YAML file for error
+    output.
+
+    exported_metric_groups may be the result of a previous call to
+    get_exported_metric_groups() for the same input, to avoid determining the
+    exported metric groups again. If None, they are determined.
+
+    Returns a tuple(context, resources, uri2resource), where:
+      * context is the metric context
+      * resources is a dict(key: metric group name, value: list of
+        auto-enabled resource objects for the metric group).
+      * uri2resource is a dict(key: resource URI, value: auto-enabled resource
+        object for the URI).
+
+    Raises: zhmccclient exceptions
+    """
+    if exported_metric_groups is None:
+        exported_metric_groups = get_exported_metric_groups(
+            config_dict, yaml_metric_groups, hmc_version, hmc_api_version,
+            hmc_features)
+    exported_hmc_metric_groups, exported_res_metric_groups, need_cpcs = \
+        exported_metric_groups
 
     client = zhmcclient.Client(session)
 
@@ -911,143 +1281,64 @@ def create_metrics_context(
         {"anticipated-frequency-seconds": 15,
          "metric-groups": exported_hmc_metric_groups})
 
+    # List the CPCs only once, and only if needed
+    if need_cpcs or \
+            'partition-attached-network-interface' in \
+            exported_hmc_metric_groups:
+        cpcs = client.cpcs.list()
+    else:
+        cpcs = []
+
     resources = {}
     uri2resource = {}
-    for metric_group in exported_res_metric_groups:
+    for metric_group, list_func in exported_res_metric_groups:
         logprint(logging.INFO, PRINT_V,
                  "Retrieving resources from the HMC for resource metric "
                  f"group {metric_group}")
-        try:
-            resource_path = yaml_metric_groups[metric_group]['resource']
-        except KeyError:
-            new_exc = InvalidMetricDefinitionFile(
-                "Missing 'resource' item in resource metric group "
-                f"{metric_group} in the metric definition file")
-            new_exc.__cause__ = None  # pylint: disable=invalid-name
-            raise new_exc
-        if resource_path == 'cpc':
-            resources[metric_group] = []
-            cpcs = client.cpcs.list()
-            for cpc in cpcs:
-                logprint(logging.INFO, PRINT_V,
-                         f"Enabling auto-update for CPC {cpc.name}")
-                try:
-                    cpc.enable_auto_update()
-                except zhmcclient.Error as exc:
-                    logprint(logging.ERROR, PRINT_ALWAYS,
-                             f"Not providing metric group {metric_group!r} "
-                             f"for CPC {cpc.name}, because enabling "
-                             "auto-update for it failed with "
-                             f"{exc.__class__.__name__}: {exc}")
-                    continue  # skip this CPC
-                resources[metric_group].append(cpc)
-                uri2resource[cpc.uri] = cpc
-        elif resource_path == 'cpc.partition':
-            resources[metric_group] = []
-            cpcs = client.cpcs.list()
-            for cpc in cpcs:
-                partitions = cpc.partitions.list()
-                for partition in partitions:
-                    logprint(logging.INFO, PRINT_V,
-                             "Enabling auto-update for partition "
-                             f"{cpc.name}.{partition.name}")
-                    try:
-                        partition.enable_auto_update()
-                    except zhmcclient.Error as exc:
-                        logprint(logging.ERROR, PRINT_ALWAYS,
-                                 f"Not providing metric group {metric_group!r} "
-                                 f"for partition {cpc.name}.{partition.name}, "
-                                 "because enabling auto-update for it failed "
-                                 f"with {exc.__class__.__name__}: {exc}")
-                        continue  # skip this partition
-                    resources[metric_group].append(partition)
-                    uri2resource[partition.uri] = partition
-        elif resource_path == 'cpc.logical-partition':
-            resources[metric_group] = []
-            cpcs = client.cpcs.list()
-            for cpc in cpcs:
-                lpars = cpc.lpars.list()
-                for lpar in lpars:
-                    logprint(logging.INFO, PRINT_V,
-                             "Enabling auto-update for LPAR "
-                             f"{cpc.name}.{lpar.name}")
-                    try:
-                        lpar.enable_auto_update()
-                    except zhmcclient.Error as exc:
-                        logprint(logging.ERROR, PRINT_ALWAYS,
-                                 f"Not providing metric group {metric_group!r} "
-                                 f"for LPAR {cpc.name}.{lpar.name}, because "
-                                 "enabling auto-update for it failed with "
-                                 f"{exc.__class__.__name__}: {exc}")
-                        continue  # skip this LPAR
-                    resources[metric_group].append(lpar)
-                    uri2resource[lpar.uri] = lpar
-        elif resource_path == 'console.storagegroup':
-            resources[metric_group] = []
-            console = client.consoles.console
-            storage_groups = console.storage_groups.list()
-            for sg in storage_groups:
-                logprint(logging.INFO, PRINT_V,
-                         f"Enabling auto-update for storage group {sg.name}")
-                try:
-                    sg.enable_auto_update()
-                except zhmcclient.Error as exc:
-                    logprint(logging.ERROR, PRINT_ALWAYS,
-                             f"Not providing metric group {metric_group!r} for "
-                             f"storage group {sg.name}, because enabling "
-                             "auto-update for it failed with "
-                             f"{exc.__class__.__name__}: {exc}")
-                    continue  # skip this storage group
-                resources[metric_group].append(sg)
-                uri2resource[sg.uri] = sg
-        elif resource_path == 'console.storagevolume':
-            resources[metric_group] = []
-            console = client.consoles.console
-            storage_groups = console.storage_groups.list()
-            for sg in storage_groups:
-                storage_volumes = sg.storage_volumes.list()
-                for sv in storage_volumes:
-                    logprint(logging.INFO, PRINT_V,
-                             "Enabling auto-update for storage volume "
-                             f"{sg.name}.{sv.name}")
-                    try:
-                        sv.enable_auto_update()
-                    except zhmcclient.Error as exc:
-                        logprint(logging.ERROR, PRINT_ALWAYS,
-                                 f"Not providing metric group {metric_group!r} "
-                                 f"for storage volume {sg.name}.{sv.name}, "
-                                 "because enabling auto-update for it failed "
-                                 f"with {exc.__class__.__name__}: {exc}")
-                        continue  # skip this storage group
-                    resources[metric_group].append(sv)
-                    uri2resource[sv.uri] = sv
-        else:
-            new_exc = InvalidMetricDefinitionFile(
-                f"Unknown resource item {resource_path!r} in resource "
-                f"metric group {metric_group!r} in the metric definition "
-                "file.")
-            new_exc.__cause__ = None  # pylint: disable=invalid-name
-            raise new_exc
+        res_items = list_func(client, cpcs)
+
+        mg_resources = resources[metric_group] = []
+        add_resource = mg_resources.append
+        for resource, res_str in res_items:
+            if enable_auto_update(metric_group, resource, res_str):
+                add_resource(resource)
+                uri2resource[resource.uri] = resource
 
     # Fetch backing adapters of NICs, if needed
     if 'partition-attached-network-interface' in exported_hmc_metric_groups:
-        cpcs = client.cpcs.list()
-        for cpc in cpcs:
-            partitions = cpc.partitions.list()
+        backing_props = {}  # Properties of vswitches, ports, adapters by URI
+        if hmc_api_version >= (4, 1):
+            # HMC 2.16 and higher can return the NIC URIs in the partition
+            # list result, which avoids retrieving the full set of properties
+            # of each partition when listing its NICs.
+            partition_props = ['nic-uris']
+        else:
+            partition_props = None
+        nic_items = []  # List of tuple(cpc, partition, nic)
+        for cpc, partitions in list_per_cpc(
+                cpcs, lambda cpc: cpc.partitions.list(
+                    additional_properties=partition_props)):
             for partition in partitions:
-                nics = partition.nics.list()
-                for nic in nics:
+                for nic in partition.nics.list():
+                    nic_items.append((cpc, partition, nic))
 
-                    logprint(logging.INFO, PRINT_V,
-                             "Getting backing adapter port for NIC "
-                             f"{cpc.name}.{partition.name}.{nic.name}")
-                    adapter_name, port_index = get_backing_adapter_info(nic)
+        # The NIC name and backing properties are not in the NIC list result,
+        # so the full properties of each NIC are needed.
+        pull_full_properties([nic for _, _, nic in nic_items])
+
+        for cpc, partition, nic in nic_items:
 
-                    # Store the adapter port data as dynamic attributes on the
-                    # Nic object in the uri2resource dict.
-                    nic.adapter_name = adapter_name
-                    nic.port_index = port_index
-                    uri2resource[nic.uri] = nic
+            logprint(logging.INFO, PRINT_V,
+                     "Getting backing adapter port for NIC %s.%s.%s",
+                     cpc.name, partition.name, nic.name)
+            adapter_name, port_index = get_backing_adapter_info(
+                nic, backing_props)
+
+            # Store the adapter port data as dynamic attributes on the
+            # Nic object in the uri2resource dict.
+            nic.adapter_name = adapter_name
+            nic.port_index = port_index
+            uri2resource[nic.uri] = nic
 
     return context, resources, uri2resource
 
@@ -1126,21 +1417,28 @@ class ResourceCache:
     """
     Cache for zhmcclient resource objects to avoid having to look them up
     repeatedly.
+
+    The cache may be used concurrently by multiple threads, e.g. when
+    multiple scrapes are served at the same time. Modifications of the
+    cache are serialized by a lock.
     """
 
+    __slots__ = ('_resources', '_cpcs', '_lock')
+
     def __init__(self):
         self._resources = {}  # dict URI -> Resource object
+        self._cpcs = {}  # dict URI -> Cpc object of the resource, or None
+        self._lock = threading.Lock()  # Serializes cache modifications
 
     def resource(self, uri, object_value):
         """
         Return the zhmcclient resource object for the URI, updating the cache
         if not present.
         """
-        try:
-            _resource = self._resources[uri]
-        except KeyError:
+        _resource = self._resources.get(uri)
+        if _resource is None:
             logprint(logging.INFO, PRINT_VV,
-                     f"Finding resource for {uri}")
+                     "Finding resource for %s", uri)
             try:
                 _resource = object_value.resource  # Takes time to find on HMC
             except zhmcclient.MetricsResourceNotFound as exc:
@@ -1158,11 +1456,16 @@ class ResourceCache:
                                  f"({res.name})")
                 logprint(logging.WARNING, PRINT_ALWAYS,
                          "Details: Current resource cache:")
-                for res in self._resources.values():
+                with self._lock:
+                    cached_resources = list(self._resources.values())
+                for res in cached_resources:
                     logprint(logging.WARNING, PRINT_ALWAYS,
                              f"Details: Resource cache: {res.uri} ({res.name})")
                 raise
-            self._resources[uri] = _resource
+            # The lookup on the HMC is done without holding the lock, so
+            # another thread may have added the resource in the meantime.
+            with self._lock:
+                _resource = self._resources.setdefault(uri, _resource)
         return _resource
 
     def remove(self, uri):
@@ -1170,10 +1473,40 @@ class ResourceCache:
         Remove the resource with a specified URI from the cache, if present.
         If not present, nothing happens.
         """
+        with self._lock:
+            self._resources.pop(uri, None)
+            self._cpcs.pop(uri, None)
+
+    def cpc(self, resource):
+        """
+        Return the zhmcclient.Cpc object for the CPC of the resource, or None
+        if the resource is not a CPC or part of a CPC, updating the cache if
+        not present.
+        """
+        uri = resource.uri
         try:
-            del self._resources[uri]
+            return self._cpcs[uri]
         except KeyError:
-            pass
+            cpc = cpc_from_resource(resource)
+            with self._lock:
+                self._cpcs[uri] = cpc
+            return cpc
+
+
+@functools.lru_cache(maxsize=JINJA2_CACHE_SIZE)
+def compile_jinja2_expression(env, expression, undefined_to_none=True):
+    """
+    Compile a Jinja2 expression in a Jinja2 environment and return the
+    callable for evaluating it.
+
+    The expressions in the metric definition file are evaluated for each
+    resource on each scrape, so the compiled expressions are cached.
+
+    Raises:
+        jinja2.exceptions.TemplateError
+    """
+    return env.compile_expression(
+        expression, undefined_to_none=undefined_to_none)
 
 
 def expand_global_label_value(
@@ -1182,7 +1515,7 @@ def expand_global_label_value(
     Expand a Jinja2 expression on a label value, for a global (extra) label.
     """
     try:
-        func = env.compile_expression(item_value)
+        func = compile_jinja2_expression(env, item_value)
     except jinja2.TemplateSyntaxError as exc:
         logprint(logging.WARNING, PRINT_ALWAYS,
                  f"Not adding global label '{label_name}' due to syntax error "
@@ -1201,15 +1534,33 @@ def expand_global_label_value(
     return str(value)
 
 
-def get_backing_adapter_info(nic):
+def get_backing_adapter_info(nic, props_by_uri=None):
     """
     Return backing adapter and port of the specified NIC.
 
+    Parameters:
+      nic (zhmcclient.Nic): The NIC.
+      props_by_uri (dict): Optional cache for the properties of the virtual
+        switches, adapter ports and adapters retrieved from the HMC, with key:
+        URI, value: dict of properties. Many NICs are backed by the same
+        virtual switch or adapter, so passing the same dict for all NICs
+        avoids retrieving them from the HMC again for each NIC.
+
     Returns:
       tuple(adapter_name, port_index)
     """
 
     session = nic.manager.session
+    if props_by_uri is None:
+        props_by_uri = {}
+
+    def get_props(uri):
+        try:
+            props = props_by_uri[uri]
+        except KeyError:
+            props = session.get(uri)
+            props_by_uri[uri] = props
+        return props
 
     # Handle vswitch-based NIC (OSA, HS)
     try:
@@ -1217,16 +1568,16 @@ def get_backing_adapter_info(nic):
     except KeyError:
         pass
     else:
-        vswitch_props = session.get(vswitch_uri)
+        vswitch_props = get_props(vswitch_uri)
         adapter_uri = vswitch_props['backing-adapter-uri']
-        adapter_props = session.get(adapter_uri)
+        adapter_props = get_props(adapter_uri)
         return adapter_props['name'], vswitch_props['port']
 
     # Handle adapter-based NIC (RoCE, CNA)
     port_uri = nic.get_property('network-adapter-port-uri')
-    port_props = session.get(port_uri)
+    port_props = get_props(port_uri)
     adapter_uri = port_props['parent']
-    adapter_props = session.get(adapter_uri)
+    adapter_props = get_props(adapter_uri)
     return adapter_props['name'], port_props['index']
 
 
@@ -1247,18 +1598,25 @@ def uri_to_resource(client, uri2resource, uri):
       * cpc - used in storage-group and storage-volume metric groups
     """
 
-    try:
-        resource = uri2resource[uri]
-    except KeyError:
+    resource = uri2resource.get(uri)
+    if resource is None:
         # The uri2resource dict was created at startup time of the
         # exporter and was filled with all resources (of types the exporter
-        # supports) that existed at that time. The KeyError means that
+        # supports) that existed at that time. A missing URI means that
         # a new resource came into existence since then.
 
-        m = re.match(r'(/api/partitions/[a-f0-9\-]+)/nics/[a-f0-9\-]+$', uri)
-        if m is not None:
+        # The supported URIs have the form '/api/{coll}/{id}' or
+        # '/api/{coll}/{id}/{subcoll}/{subid}', so splitting them at '/'
+        # results in 4 or 6 items, with an empty first item. URIs with
+        # any other empty item (e.g. an empty ID) are not supported.
+        parts = uri.split('/')
+        num_parts = len(parts) \
+            if parts[1:2] == ['api'] and all(parts[1:]) else 0
+
+        if num_parts == 6 and parts[2] == 'partitions' and \
+                parts[4] == 'nics':
             # Resource URI is for a NIC
-            partition_uri = m.group(1)
+            partition_uri = '/'.join(parts[:4])
             partition_props = client.session.get(partition_uri)
             cpc_uri = partition_props['parent']
             cpc = client.cpcs.resource_object(cpc_uri)
@@ -1270,8 +1628,7 @@ def uri_to_resource(client, uri2resource, uri):
             uri2resource[uri] = nic
             return nic
 
-        m = re.match(r'(/api/storage-groups/[a-f0-9\-]+)$', uri)
-        if m is not None:
+        if num_parts == 4 and parts[2] == 'storage-groups':
             # Resource URI is for a storage group
             console = client.consoles.console
             stogrp = console.storage_groups.resource_object(uri)
@@ -1286,8 +1643,7 @@ def uri_to_resource(client, uri2resource, uri):
             uri2resource[uri] = stogrp
             return stogrp
 
-        m = re.match(r'(/api/cpcs/[a-f0-9\-]+)$', uri)
-        if m is not None:
+        if num_parts == 4 and parts[2] == 'cpcs':
             # Resource URI is for a CPC
             cpc = client.cpcs.resource_object(uri)
             logprint(logging.INFO, PRINT_V,
@@ -1329,7 +1685,7 @@ def expand_group_label_value(
         return str(nic_org.port_index)
 
     try:
-        func = env.compile_expression(item_value)
+        func = compile_jinja2_expression(env, item_value)
     except jinja2.TemplateSyntaxError as exc:
         logprint(logging.WARNING, PRINT_ALWAYS,
                  f"Not adding label '{label_name}' to metrics of metric "
@@ -1382,7 +1738,7 @@ def expand_metric_label_value(
         return str(nic_org.port_index)
 
     try:
-        func = env.compile_expression(item_value)
+        func = compile_jinja2_expression(env, item_value)
     except jinja2.TemplateSyntaxError as exc:
         logprint(logging.WARNING, PRINT_ALWAYS,
                  f"Not adding label '{label_name}' on Prometheus metric "
@@ -1409,12 +1765,35 @@ def expand_metric_label_value(
     return str(value)
 
 
+# Number of parent levels from a resource to its CPC, by resource class name
+# of resources that are part of a CPC
+CPC_PARENT_LEVELS = {
+    'cpc': 0,
+    'partition': 1,
+    'logical-partition': 1,
+    'adapter': 1,
+    'virtual-switch': 1,
+    'nic': 2,
+    'network-port': 2,
+    'storage-port': 2,
+}
+
+
 def cpc_from_resource(resource):
     """
     From a given zhmcclient resource object, try to navigate to its CPC
     and return the zhmcclient.Cpc object.
     If the resource is not a CPC or part of a CPC, return None.
     """
+    if resource is None:
+        return None
+    levels = CPC_PARENT_LEVELS.get(resource.manager.class_name)
+    if levels is not None:
+        cpc = resource
+        for _ in range(levels):
+            cpc = cpc.manager.parent
+        return cpc
+    # For other resource classes, walk up the parents
     cpc = resource
     while True:
         if cpc is None or cpc.manager.class_name == 'cpc':
@@ -1440,7 +1819,11 @@ def build_family_objects(
       family_name:
         GaugeMetricFamily object
     """
-    env = jinja2.Environment(autoescape=True)
+    # pylint: disable=import-outside-toplevel
+    from .vendor.prometheus_client.core import GaugeMetricFamily, \
+        CounterMetricFamily
+
+    env = JINJA2_ENV
     client = zhmcclient.Client(session)
 
     family_objects = {}
@@ -1455,6 +1838,12 @@ def build_family_objects(
                 "open an exporter issue to get the new metric group supported.")
             continue  # Skip this metric group
 
+        # The metric definitions of the metric group, and its labels.
+        # labels is optional in the metrics schema:
+        yaml_mg_metrics = yaml_metrics.get(metric_group, {})
+        default_labels = [dict(name='resource', value='resource_obj.name')]
+        yaml_labels = yaml_metric_group.get('labels', default_labels)
+
         for object_value in metric_group_value.object_values:
             if resource_cache:
                 try:
@@ -1472,7 +1861,10 @@ def build_family_objects(
                 resource = object_value.resource
             metric_values = object_value.metrics
 
-            cpc = cpc_from_resource(resource)
+            if resource_cache:
+                cpc = resource_cache.cpc(resource)
+            else:
+                cpc = cpc_from_resource(resource)
             if cpc:
                 # This resource is a CPC or part of a CPC
                 se_version = se_versions_by_cpc[cpc.name]
@@ -1484,9 +1876,6 @@ def build_family_objects(
 
             # Calculate the resource labels at the metric group level:
             mg_labels = dict(extra_labels)
-            # labels is optional in the metrics schema:
-            default_labels = [dict(name='resource', value='resource_obj.name')]
-            yaml_labels = yaml_metric_group.get('labels', default_labels)
             for item in yaml_labels:
                 # name, value are required in the metrics schema:
                 label_name = item['name']
@@ -1497,10 +1886,10 @@ def build_family_objects(
                 if label_value is not None:
                     mg_labels[label_name] = label_value
 
-            for metric in metric_values:
+            for metric, metric_value in metric_values.items():
 
                 try:
-                    yaml_metric = yaml_metrics[metric_group][metric]
+                    yaml_metric = yaml_mg_metrics[metric]
                 except KeyError:
                     warnings.warn(
                         f"The HMC supports a new metric {metric!r} in "
@@ -1510,8 +1899,6 @@ def build_family_objects(
                         "supported.")
                     continue  # Skip this metric
 
-                metric_value = metric_values[metric]
-
                 # Skip metrics with the special value -1 (which indicates that
                 # the resource does not exist)
                 if metric_value == -1:
@@ -1555,9 +1942,9 @@ def build_family_objects(
 
                 # Create a Family object, if needed
                 # prefix,exporter_name are required in the metrics schema:
-                family_name = "zhmc_{}_{}".format(
-                    yaml_metric_group["prefix"],
-                    yaml_metric["exporter_name"])
+                family_name = \
+                    f"zhmc_{yaml_metric_group['prefix']}_" \
+                    f"{yaml_metric['exporter_name']}"
                 try:
                     family_object = family_objects[family_name]
                 except KeyError:
@@ -1600,7 +1987,11 @@ def build_family_objects_res(
       family_name:
         GaugeMetricFamily object
     """
-    env = jinja2.Environment(autoescape=True)
+    # pylint: disable=import-outside-toplevel
+    from .vendor.prometheus_client.core import GaugeMetricFamily, \
+        CounterMetricFamily
+
+    env = JINJA2_ENV
     client = zhmcclient.Client(session)
 
     family_objects = {}
@@ -1609,6 +2000,12 @@ def build_family_objects_res(
         ceased_res_indexes = []  # Indexes into res_list
 
         yaml_metric_group = yaml_metric_groups[metric_group]
+        # labels is optional in the metrics schema:
+        default_labels = [dict(name='resource', value='resource_obj.name')]
+        yaml_labels = yaml_metric_group.get('labels', default_labels)
+        yaml_mg = yaml_metrics[metric_group]
+        yaml_mg_is_dict = isinstance(yaml_mg, dict)
+
         for i, resource in enumerate(res_list):
 
             if resource.ceased_existence:
@@ -1619,15 +2016,18 @@ def build_family_objects_res(
                     # the name is not yet known locally.
                     res_str = f"with URI {resource.uri}"
                 logprint(logging.INFO, PRINT_VV,
-                         "Resource no longer exists on HMC: "
-                         f"{resource.manager.class_name} {res_str}")
+                         "Resource no longer exists on HMC: %s %s",
+                         resource.manager.class_name, res_str)
 
                 # Remember the resource to be removed
                 ceased_res_indexes.append(i)
 
                 continue
 
-            cpc = cpc_from_resource(resource)
+            if resource_cache:
+                cpc = resource_cache.cpc(resource)
+            else:
+                cpc = cpc_from_resource(resource)
             if cpc:
                 # This resource is a CPC or part of a CPC
                 se_version = se_versions_by_cpc[cpc.name]
@@ -1639,9 +2039,6 @@ def build_family_objects_res(
 
             # Calculate the resource labels at the metric group level:
             mg_labels = dict(extra_labels)
-            # labels is optional in the metrics schema:
-            default_labels = [dict(name='resource', value='resource_obj.name')]
-            yaml_labels = yaml_metric_group.get('labels', default_labels)
             for item in yaml_labels:
                 # name, value are required in the metrics schema:
                 label_name = item['name']
@@ -1652,13 +2049,12 @@ def build_family_objects_res(
                 if label_value is not None:
                     mg_labels[label_name] = label_value
 
-            yaml_mg = yaml_metrics[metric_group]
-            if isinstance(yaml_mg, dict):
+            if yaml_mg_is_dict:
                 yaml_mg_iter = yaml_mg.items()
             else:
                 yaml_mg_iter = yaml_mg
             for item in yaml_mg_iter:
-                if isinstance(yaml_mg, dict):
+                if yaml_mg_is_dict:
                     prop_name, yaml_metric = item
                 else:
                     yaml_metric = item
@@ -1709,8 +2105,8 @@ def build_family_objects_res(
                         raise new_exc
 
                     try:
-                        func = env.compile_expression(
-                            prop_expr, undefined_to_none=False)
+                        func = compile_jinja2_expression(
+                            env, prop_expr, undefined_to_none=False)
                     except jinja2.exceptions.TemplateError as exc:
                         new_exc = InvalidMetricDefinitionFile(
                             "Error compiling properties expression "
@@ -1798,9 +2194,9 @@ def build_family_objects_res(
 
                 # Create a Family object, if needed
                 # prefix,exporter_name are required in the metrics schema:
-                family_name = "zhmc_{}_{}".format(
-                    yaml_metric_group["prefix"],
-                    yaml_metric["exporter_name"])
+                family_name = \
+                    f"zhmc_{yaml_metric_group['prefix']}_" \
+                    f"{yaml_metric['exporter_name']}"
                 try:
                     family_object = family_objects[family_name]
                 except KeyError:
@@ -1845,6 +2241,15 @@ class ZHMCUsageCollector():
     # pylint: disable=too-few-public-methods,too-many-instance-attributes
     """Collects the usage for exporting."""
 
+    __slots__ = (
+        'config_dict', 'session', 'context', 'resources',
+        'yaml_metric_groups', 'yaml_metrics', 'yaml_fetch_properties',
+        'extra_labels', 'metrics_filename', 'config_filename',
+        'resource_cache', 'uri2resource', 'hmc_version', 'hmc_api_version',
+        'hmc_features', 'se_versions_by_cpc', 'se_features_by_cpc',
+        'exported_metric_groups', 'fetch_thread', 'fetch_event',
+        'last_export_dt', 'export_interval')
+
     def __init__(self, config_dict, session, context, resources,
                  yaml_metric_groups, yaml_metrics, yaml_fetch_properties,
                  extra_labels, metrics_filename, config_filename,
@@ -1867,6 +2272,7 @@ class ZHMCUsageCollector():
         self.hmc_features = hmc_features
         self.se_versions_by_cpc = se_versions_by_cpc
         self.se_features_by_cpc = se_features_by_cpc
+        self.exported_metric_groups = None  # Determined on first need
         self.fetch_thread = None
         self.fetch_event = None
         self.last_export_dt = None
@@ -1908,11 +2314,17 @@ class ZHMCUsageCollector():
                         logprint(logging.WARNING, PRINT_ALWAYS,
                                  "Recreating the metrics context after HTTP "
                                  f"status {exc.http_status}.{exc.reason}")
+                        if self.exported_metric_groups is None:
+                            self.exported_metric_groups = \
+                                get_exported_metric_groups(
+                                    self.config_dict, self.yaml_metric_groups,
+                                    self.hmc_version, self.hmc_api_version,
+                                    self.hmc_features)
                         self.context, _, _ = create_metrics_context(
                             self.session, self.config_dict,
                             self.yaml_metric_groups,
                             self.hmc_version, self.hmc_api_version,
-                            self.hmc_features)
+                            self.hmc_features, self.exported_metric_groups)
                         continue
                     logprint(logging.WARNING, PRINT_ALWAYS,
                              "Retrying after HTTP status "
@@ -2069,9 +2481,8 @@ class ZHMCUsageCollector():
 
             # Update properties of our local resource objects from result
             for uri, updated_res in updated_resources.items():
-                try:
-                    res = self.uri2resource[uri]
-                except KeyError:
+                res = self.uri2resource.get(uri)
+                if res is None:
                     continue
                 res.update_properties_local(updated_res.properties)
             for fetch_item in self.yaml_fetch_properties.values():
@@ -2114,7 +2525,7 @@ VERBOSE_LEVEL = 0
 LOGGING_ENABLED = False
 
 
-def logprint(log_level, print_level, message):
+def logprint(log_level, print_level, message, *args):
     """
     Log a message at the specified log level, and print the message at
     the specified verbosity level
@@ -2124,15 +2535,18 @@ def logprint(log_level, print_level, message):
           logged (logging.DEBUG, etc.), or None for no logging.
         print_level (int): Verbosity level at which the message should be
           printed (1, 2), or None for no printing.
-        message (string): The message.
+        message (string): The message. If args are specified, this is a
+          format string for '%'-formatting with the args. The formatting is
+          performed only if the message is actually printed or logged.
+        *args: Arguments for formatting the message.
     """
     if print_level is not None and VERBOSE_LEVEL >= print_level:
-        print(message)
+        print(message % args if args else message)
     if log_level is not None and LOGGING_ENABLED:
         logger = logging.getLogger(EXPORTER_LOGGER_NAME)
         # Note: This method never raises an exception. Errors during logging
         # are handled by calling handler.handleError().
-        logger.log(log_level, message)
+        logger.log(log_level, message, *args)
 
 
 def setup_logging(log_dest, log_complevels, syslog_facility):
@@ -2144,6 +2558,10 @@ def setup_logging(log_dest, log_complevels, syslog_facility):
     """
     global LOGGING_ENABLED  # pylint: disable=global-statement
 
+    # Imported here because it is needed only when setting up logging
+    # pylint: disable=import-outside-toplevel,redefined-outer-name
+    import logging.handlers
+
     if log_dest is None:
         logprint(None, PRINT_V, "Logging is disabled")
         handler = None
@@ -2311,6 +2729,10 @@ def main():
             upgrade_config_file(config_filename)
             sys.exit(0)
 
+        # pylint: disable=import-outside-toplevel
+        from .vendor.prometheus_client import start_http_server
+        from .vendor.prometheus_client.core import REGISTRY
+
         VERBOSE_LEVEL = args.verbose
 
         setup_logging(args.log_dest, args.log_complevels, args.syslog_facility)
@@ -2339,8 +2761,11 @@ def main():
 
         logprint(logging.INFO, PRINT_V,
                  f"Parsing metric definition file: {metrics_filename}")
+        # The metric definition file is never written back, so it is loaded
+        # as plain data
         yaml_metric_content = parse_yaml_file(
-            metrics_filename, 'metric definition file', 'metrics_schema.yaml')
+            metrics_filename, 'metric definition file', 'metrics_schema.yaml',
+            round_trip=False)
         # metric_groups and metrics are required in the metrics schema:
         yaml_metric_groups = yaml_metric_content['metric_groups']
         yaml_metrics = yaml_metric_content['metrics']
@@ -2391,7 +2816,7 @@ def main():
                  f"read: {RETRY_TIMEOUT_CONFIG.read_timeout} sec / "
                  f"{RETRY_TIMEOUT_CONFIG.read_retries} retries.")
 
-        env = jinja2.Environment(autoescape=True)
+        env = JINJA2_ENV
 
         session = create_session(config_dict, config_filename)
 
@@ -2497,7 +2922,10 @@ def main():
             server_key_file = None
             ca_cert_file = None
 
-        port = int(args.p or config_port or DEFAULT_PORT)
+        if args.p is not None:
+            port = args.p
+        else:
+            port = config_port or DEFAULT_PORT
 
         if server_cert_file:
             logprint(logging.INFO, PRINT_V,
@@ -2550,7 +2978,13 @@ def main():
                  f"Exporter is up and running on port {port}")
         while True:
             try:
-                time.sleep(1)
+                if hasattr(signal, 'pause'):
+                    # Block without waking up until a signal arrives, e.g.
+                    # SIGINT for Ctrl-C
+                    signal.pause()
+                else:
+                    # signal.pause() is not available on Windows
+                    time.sleep(1)
             except KeyboardInterrupt:
                 raise ProperExit
     except KeyboardInterrupt: